@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+#
+# Benchmark of node_modules.py against synthetic lock files and a local
+# stand-in for the npm registry. Every phase runs in a process of its own so
+# that peak RSS can be reported per phase.
+
+import argparse
+import base64
+import functools
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import Namespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, "node_modules.py")
+
+PHASES = ["startup", "parse", "download", "cpio-write", "cpio-extract", "service"]
+
+SERVICE = """<services>
+  <service name="node_modules" mode="manual">
+    <param name="cpio">node_modules.obscpio</param>
+    <param name="output">node_modules.spec.inc</param>
+  </service>
+</services>
+"""
+
+class RegistryHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, which would otherwise
+    # stall every request on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+def start_registry(directory, latency):
+    handler = functools.partial(RegistryHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.url = "http://127.0.0.1:%d" % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_tarballs(directory, count, size):
+    # gzip compressed random data, as incompressible as real tarballs
+    integrities = []
+    for i in range(count):
+        name = "pkg%d" % i
+        path = os.path.join(directory, name, "-")
+        os.makedirs(path, exist_ok=True)
+        content = gzip.compress(os.urandom(size), 1)
+        with open(os.path.join(path, "%s-1.0.0.tgz" % name), "wb") as fh:
+            fh.write(content)
+        integrities.append("sha512-" + base64.b64encode(hashlib.sha512(content).digest()).decode())
+    return integrities
+
+def make_lockfile(version, url, integrities, depth):
+    # package i is nested below the last package one level up, which gives
+    # install paths up to depth levels deep
+    parents = [""]
+    packages = {"": {"name": "bench", "version": "1.0.0"}}
+    dependencies = dict()
+    trees = [dependencies]
+    for i, integrity in enumerate(integrities):
+        name = "pkg%d" % i
+        level = i % depth
+        entry = {
+            "version": "1.0.0",
+            "resolved": "%s/%s/-/%s-1.0.0.tgz" % (url, name, name),
+            "integrity": integrity,
+        }
+        path = parents[level] + "node_modules/" + name
+        packages[path] = entry
+        del parents[level + 1:]
+        parents.append(path + "/")
+
+        v2entry = dict(entry)
+        trees[level][name] = v2entry
+        del trees[level + 1:]
+        trees.append(v2entry.setdefault("dependencies", dict()))
+
+    js = {"name": "bench", "version": "1.0.0", "lockfileVersion": version, "requires": True}
+    if version == 2:
+        js["dependencies"] = dependencies
+    else:
+        js["packages"] = packages
+    return js
+
+def run_phase(name, workdir, compress=False):
+    # executed in the child process, prints what it did as json
+    sys.path.insert(0, HERE)
+    if name == "startup":
+        # items are the modules the import pulls in
+        modules = len(sys.modules)
+        start = time.perf_counter()
+        import node_modules
+        end = time.perf_counter()
+        size = os.path.getsize(node_modules.__file__)
+        json.dump({"seconds": end - start, "items": len(sys.modules) - modules, "bytes": size}, sys.stdout)
+        return 0
+    import node_modules
+
+    download = os.path.join(workdir, "download")
+    cpio = os.path.join(workdir, "node_modules.obscpio")
+    lockfile = os.path.join(workdir, "package-lock.json")
+    table = node_modules.DependencyTable()
+    if name in ("parse", "service"):
+        # the service phase only parses the lock file to get the table
+        start = time.perf_counter()
+        node_modules.read_packagelock(table, lockfile)
+    if name == "parse":
+        items, size = len(table), os.path.getsize(lockfile)
+    elif name == "cpio-write":
+        start = time.perf_counter()
+        names = sorted(os.listdir(download))
+        with node_modules.CpioWriter(cpio, compress) as c:
+            for fn in names:
+                with open(os.path.join(download, fn), "rb") as fh:
+                    c.addstream(fn, fh)
+        items, size = len(names), os.path.getsize(cpio)
+    elif name == "cpio-extract":
+        outdir = os.path.join(workdir, "extract")
+        os.mkdir(outdir)
+        start = time.perf_counter()
+        with node_modules.CpioReader(cpio) as r:
+            r.extract(outdir)
+            items = len(r.names())
+        size = os.path.getsize(cpio)
+    elif name == "service":
+        fn = os.path.join(workdir, "_service")
+        with open(fn, "w") as fh:
+            fh.write(SERVICE)
+        args = Namespace(obs_service=fn, obs_service_scm_only=False, file=None)
+        start = time.perf_counter()
+        node_modules.update_obs_service(args, table)
+        items, size = len(table), os.path.getsize(fn)
+    end = time.perf_counter()
+    json.dump({"seconds": end - start, "items": items, "bytes": size}, sys.stdout)
+    return 0
+
+def measure(cmd, cwd=None):
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, universal_newlines=True)
+    out = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    proc.stdout.close()
+    if proc.returncode:
+        raise Exception("%s failed with %d" % (" ".join(cmd), proc.returncode))
+    # ru_maxrss is in KiB on Linux
+    return wall, usage.ru_maxrss * 1024, out
+
+def benchmark(args, workdir):
+    registry = os.path.join(workdir, "registry")
+    download = os.path.join(workdir, "download")
+    os.mkdir(registry)
+    os.mkdir(download)
+    integrities = make_tarballs(registry, args.packages, args.size)
+    server = start_registry(registry, args.latency / 1000.0)
+    try:
+        js = make_lockfile(args.lockfile_version, server.url, integrities, args.depth)
+        for d in (workdir, download):
+            with open(os.path.join(d, "package-lock.json"), "w") as fh:
+                json.dump(js, fh, indent=2)
+
+        results = []
+        for phase in PHASES:
+            if phase == "download":
+                # the whole command, as it runs in the service
+                cmd = [sys.executable, SCRIPT, "--download", "--jobs", str(args.jobs)]
+                wall, rss, _ = measure(cmd, cwd=download)
+                os.unlink(os.path.join(download, "package-lock.json"))
+                files = os.listdir(download)
+                r = dict(seconds=wall, items=len(files),
+                         bytes=sum(os.path.getsize(os.path.join(download, fn)) for fn in files))
+            else:
+                cmd = [sys.executable, os.path.abspath(__file__), "--run-phase", phase, workdir,
+                       "--cpio-compression", args.cpio_compression]
+                wall, rss, out = measure(cmd)
+                r = json.loads(out)
+            r.update(phase=phase, wall=wall, peak_rss=rss)
+            results.append(r)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def report(results, baseline=None):
+    old = {r["phase"]: r for r in baseline} if baseline else {}
+    print("%-13s %9s %9s %10s %10s %11s %10s" % ("phase", "time", "wall", "peak RSS", "size", "items/s", "MB/s"))
+    for r in results:
+        seconds = max(r["seconds"], 1e-9)
+        line = "%-13s %8.3fs %8.3fs %8.1fMB %8.2fMB %11.0f %10.1f" % (
+            r["phase"], r["seconds"], r["wall"], r["peak_rss"] / 1e6, r["bytes"] / 1e6,
+            r["items"] / seconds, r["bytes"] / seconds / 1e6)
+        if r["phase"] in old:
+            line += "  %+.1f%%" % ((r["seconds"] / max(old[r["phase"]]["seconds"], 1e-9) - 1) * 100)
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark node_modules.py")
+    parser.add_argument("--run-phase", nargs=2, metavar=("PHASE", "DIR"), help=argparse.SUPPRESS)
+    parser.add_argument("-n", "--packages", type=int, default=1000, help="number of packages")
+    parser.add_argument("--depth", type=int, default=3, help="nesting depth of node_modules")
+    parser.add_argument("--lockfile-version", type=int, choices=(2, 3), default=3)
+    parser.add_argument("--size", type=int, default=16 * 1024, help="size of each tarball in bytes")
+    parser.add_argument("--latency", type=float, default=0, help="registry latency per request in ms")
+    parser.add_argument("--cpio-compression", choices=("none", "gzip"), default="none",
+                        help="write the archive in the compressed format")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="parallel downloads")
+    parser.add_argument("--workdir", help="keep the generated files in this directory")
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE, - for stdout")
+    parser.add_argument("--compare", metavar="FILE", help="show the change against an earlier --json result")
+    args = parser.parse_args()
+
+    if args.run_phase:
+        sys.exit(run_phase(*args.run_phase, compress=args.cpio_compression == "gzip"))
+
+    if args.workdir:
+        if os.path.exists(args.workdir) and os.listdir(args.workdir):
+            parser.error("%s is not empty" % args.workdir)
+        os.makedirs(args.workdir, exist_ok=True)
+        results = benchmark(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = benchmark(args, workdir)
+
+    output = dict(
+        settings=dict(packages=args.packages, depth=args.depth, lockfile_version=args.lockfile_version,
+                      size=args.size, latency=args.latency, jobs=args.jobs,
+                      cpio_compression=args.cpio_compression),
+        results=results,
+    )
+    if args.json == "-":
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        baseline = None
+        if args.compare:
+            with open(args.compare) as fh:
+                baseline = json.load(fh)["results"]
+        report(results, baseline)
+        if args.json:
+            with open(args.json, "w") as fh:
+                json.dump(output, fh, indent=2)
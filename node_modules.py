@@ -20,103 +20,525 @@
 # SOFTWARE.
 
 import argparse
+import collections
+import contextlib
+import errno
+import fcntl
 import hashlib
+import importlib.util
+import heapq
+import io
+import itertools
 import json
 import logging
+import mmap
 import os
 import glob
-import subprocess
+import random
+import shutil
 import sys
 import stat
+import tempfile
 import time
 import struct
-import urllib.error
+import threading
 import urllib.parse
-import urllib.request
+import zlib
 from base64 import b64decode
 from binascii import hexlify
-from lxml import etree as ET
 
 from pathlib import Path
 
-# filename -> { url: <string>, sum: <string>, path = set([<string>, ..]) }
-MODULE_MAP = dict()
+def _lazy_import(name):
+    # the module is only loaded once one of its attributes is used, so runs
+    # that never download do not pay for it. None if it is not installed
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+asyncio = _lazy_import("asyncio")
+urllib3 = _lazy_import("urllib3")
+
+# read size when streaming tarballs to disk
+CHUNK_SIZE = 64 * 1024
+# smaller files are hashed from a single read, mapping them costs more
+MMAP_MIN = 1 << 20
+
+DEFAULT_REGISTRY = "https://registry.npmjs.org/"
+
+# transient http errors worth another try, and the backoff between tries
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# bump when resolution changes so cached results are not used anymore
+RESOLVE_CACHE_VERSION = 1
+
+# compressed archives are a series of gzip members, each holding whole cpio
+# records of up to about FRAME_SIZE bytes so that single members can be read
+# without decompressing everything before them. The frame index is another
+# gzip member, found through a fixed size empty gzip member at the very end
+# that carries its offset in an extra field
+FRAME_SIZE = 1 << 20
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_HEADER = GZIP_MAGIC + b'\x08\x00\x00\x00\x00\x00\x00\xff'
+FOOTER = struct.Struct('<4sIBBH2sHQ2sII')
+# payloads starting like this (gzip, xz, bzip2, zstd) are only stored
+PRECOMPRESSED = (GZIP_MAGIC, b'\xfd7zXZ\x00', b'BZh', b'\x28\xb5\x2f\xfd')
+
+# ioctl to share extents with another file (btrfs, xfs)
+FICLONE = 0x40049409
+
+def _kernel_copies():
+    copies = []
+    if hasattr(os, 'copy_file_range'):
+        copies.append(lambda ifd, ofd, offset, count: os.copy_file_range(ifd, ofd, count, offset))
+    if hasattr(os, 'sendfile'):
+        copies.append(lambda ifd, ofd, offset, count: os.sendfile(ofd, ifd, offset, count))
+    return copies
+
+KERNEL_COPIES = _kernel_copies()
+
+def _copy_range(ifh, ofh, offset, size):
+    # move the data between the descriptors in the kernel if possible, so it
+    # never passes through python objects. Both files end up positioned
+    # after the range
+    ofh.flush()
+    pos = ofh.tell()
+    done = 0
+    for copy in KERNEL_COPIES:
+        try:
+            while done < size:
+                n = copy(ifh.fileno(), ofh.fileno(), offset + done, size - done)
+                if not n:
+                    raise Exception("short read at offset %d" % (offset + done))
+                done += n
+            break
+        except OSError as e:
+            if done or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    else:
+        ifh.seek(offset)
+        while done < size:
+            data = ifh.read(min(CHUNK_SIZE, size - done))
+            if not data:
+                raise Exception("short read at offset %d" % ifh.tell())
+            ofh.write(data)
+            done += len(data)
+    ofh.seek(pos + size)
+    ifh.seek(offset + size)
+
+class Metrics:
+    # phase timings, event counters and per tarball downloads of a run
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.seconds = collections.Counter()
+        self.downloads = []
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.seconds[name] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def hashed(self, size, seconds):
+        # seconds are summed over all threads, so size / seconds is the
+        # throughput of one core
+        with self._lock:
+            self.counters["hash_bytes"] += size
+            self.seconds["hash"] += seconds
+
+    def download(self, fn, latency, seconds, size):
+        with self._lock:
+            self.downloads.append((fn, latency, seconds, size))
+            self.counters["download_bytes"] += size
+
+    def rate(self, hits, misses):
+        total = self.counters[hits] + sum(self.counters[m] for m in misses)
+        return self.counters[hits] / total if total else None
+
+    def as_dict(self):
+        return {
+            "seconds": dict(sorted(self.seconds.items())),
+            "counters": dict(sorted(self.counters.items())),
+            "downloads": [
+                {"filename": fn, "latency": latency, "seconds": seconds, "bytes": size}
+                for fn, latency, seconds, size in sorted(self.downloads)
+            ],
+        }
+
+    def write_prometheus(self, fh):
+        fh.write("# TYPE node_modules_phase_seconds gauge\n")
+        for name, value in sorted(self.seconds.items()):
+            fh.write('node_modules_phase_seconds{phase="%s"} %f\n' % (name, value))
+        fh.write("# TYPE node_modules_events_total counter\n")
+        for name, value in sorted(self.counters.items()):
+            fh.write('node_modules_events_total{event="%s"} %d\n' % (name, value))
+        fh.write("# TYPE node_modules_download_seconds histogram\n")
+        durations = sorted(d[2] for d in self.downloads)
+        n = 0
+        for bucket in self.BUCKETS:
+            while n < len(durations) and durations[n] <= bucket:
+                n += 1
+            fh.write('node_modules_download_seconds_bucket{le="%s"} %d\n' % (bucket, n))
+        fh.write('node_modules_download_seconds_bucket{le="+Inf"} %d\n' % len(durations))
+        fh.write("node_modules_download_seconds_sum %f\n" % sum(durations))
+        fh.write("node_modules_download_seconds_count %d\n" % len(durations))
+
+    def write(self, fn):
+        # written atomically, as the node exporter may pick it up any time
+        with open(fn + ".new", "w") as fh:
+            if fn.endswith(".prom"):
+                self.write_prometheus(fh)
+            else:
+                json.dump(self.as_dict(), fh, indent=2)
+                fh.write("\n")
+        os.rename(fn + ".new", fn)
+
+    def summary(self):
+        lines = []
+        for name, value in sorted(self.seconds.items()):
+            lines.append("%-16s %8.3fs" % (name, value))
+        if self.downloads:
+            size = self.counters["download_bytes"]
+            seconds = sum(d[2] for d in self.downloads)
+            latencies = sorted(d[1] for d in self.downloads)
+            lines.append(
+                "downloads        %d, %.1f MB, %.1f MB/s per connection, latency median %.3fs max %.3fs" % (
+                    len(self.downloads),
+                    size / 1e6,
+                    size / 1e6 / seconds if seconds else 0,
+                    latencies[len(latencies) // 2],
+                    latencies[-1],
+                ))
+        if self.counters["hash_bytes"]:
+            size = self.counters["hash_bytes"]
+            seconds = self.seconds["hash"]
+            lines.append("hashing          %.1f MB, %.1f MB/s per core" % (
+                size / 1e6, size / 1e6 / seconds if seconds else 0))
+        for label, hits, misses in (
+            ("cache hits", "cached", ("cache_misses",)),
+            ("skipped", "skipped", ("fetched", "cached")),
+        ):
+            rate = self.rate(hits, misses)
+            if rate is not None:
+                lines.append("%-16s %7.1f%%" % (label, rate * 100))
+        for name in ("retries", "failed"):
+            if self.counters[name]:
+                lines.append("%-16s %8d" % (name, self.counters[name]))
+        return lines
+
+def _pread_chunks(fh, offset, size):
+    done = 0
+    while done < size:
+        data = os.pread(fh.fileno(), min(CHUNK_SIZE, size - done), offset + done)
+        if not data:
+            raise Exception("short read at offset %d" % (offset + done))
+        done += len(data)
+        yield data
+
+class CpioFile:
+    def __init__(self, fh):
+        self.fh = fh
+        self.name = None
 
-# this is a hack for obs_scm integration
-OBS_SCM_COMPRESSION = None
+    def __enter__(self):
+        if (self.fh.tell() & 3):
+            raise Exception("invalid offset %d" % self.fh.tell())
 
-class CpioReader:
-    def __init__(self, fn):
-        self.fh = open(fn, 'rb')
+        fmt = "6s8s8s8s8s8s8s8s8s8s8s8s8s8s"
 
-    def extract(self, outdir):
+        fields = struct.unpack(fmt, self.fh.read(struct.calcsize(fmt)))
 
-        class CpioFile:
-            def __init__(self, fh):
-                self.fh = fh
-                self.name = None
+        if fields[0] != b"070701":
+            raise Exception("invalid cpio header %s" % fields[0])
 
-            def __enter__(self):
-                if (self.fh.tell() & 3):
-                    raise Exception("invalid offset %d" % self.fh.tell())
+        names = ("c_ino", "c_mode", "c_uid", "c_gid",
+                 "c_nlink", "c_mtime", "c_filesize",
+                 "c_devmajor", "c_devminor", "c_rdevmajor",
+                 "c_rdevminor", "c_namesize", "c_check")
+        for (n, v) in zip(names, fields[1:]):
+            setattr(self, n, int(v, 16))
 
-                fmt = "6s8s8s8s8s8s8s8s8s8s8s8s8s8s"
+        self.name = struct.unpack('%ds' % (self.c_namesize - 1), self.fh.read(self.c_namesize - 1))[0]
+        self.fh.read(1)  # \0
+        if (self.c_namesize+2) % 4:
+            self.fh.read(4 - (self.c_namesize+2) % 4)
 
-                fields = struct.unpack(fmt, self.fh.read(struct.calcsize(fmt)))
+        return self
 
-                if fields[0] != b"070701":
-                    raise Exception("invalid cpio header %s" % fields[0])
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            return None
+        if self.c_filesize % 4:
+            self.fh.read(4 - self.c_filesize % 4)
 
-                names = ("c_ino", "c_mode", "c_uid", "c_gid",
-                         "c_nlink", "c_mtime", "c_filesize",
-                         "c_devmajor", "c_devminor", "c_rdevmajor",
-                         "c_rdevminor", "c_namesize", "c_check")
-                for (n, v) in zip(names, fields[1:]):
-                    setattr(self, n, int(v, 16))
+    def last(self):
+        return self.name == b'TRAILER!!!'
 
-                self.name = struct.unpack('%ds' % (self.c_namesize - 1), self.fh.read(self.c_namesize - 1))[0]
-                self.fh.read(1)  # \0
-                if (self.c_namesize+2) % 4:
-                    self.fh.read(4 - (self.c_namesize+2) % 4)
+    def __str__(self):
+        return "[%s %d]" % (self.name, self.c_filesize)
 
-                return self
+    def read(self):
+        return self.fh.read(self.c_filesize)
 
-            def __exit__(self, exc_type, exc_value, traceback):
-                if exc_type:
-                    return None
-                if self.c_filesize % 4:
-                    self.fh.read(4 - self.c_filesize % 4)
+    def skip(self):
+        self.fh.seek(self.c_filesize, os.SEEK_CUR)
 
-            def last(self):
-                return self.name == b'TRAILER!!!'
 
-            def __str__(self):
-                return "[%s %d]" % (self.name, self.c_filesize)
+# location of a member's data in an archive, header is the parsed CpioFile.
+# In compressed archives offset is relative to the uncompressed frame that
+# starts at file offset frame and has framesize compressed bytes
+CpioEntry = collections.namedtuple("CpioEntry", ("offset", "size", "header", "frame", "framesize"))
 
-            def read(self):
-                return self.fh.read(self.c_filesize)
+def _gzip_footer(index_offset):
+    return FOOTER.pack(GZIP_MAGIC + b'\x08\x04', 0, 0, 255, 12, b'NM', 8, index_offset, b'\x03\x00', 0, 0)
 
-        while True:
-            with CpioFile(self.fh) as f:
-                if f.last():
-                    break
-                with open(os.path.join(outdir if outdir else '.', os.path.basename(f.name.decode())), 'wb') as ofh:
-                    ofh.write(f.read())
+class CpioReader:
+    def __init__(self, fn):
+        self.fh = open(fn, 'rb')
+        self.compressed = os.pread(self.fh.fileno(), 2, 0) == GZIP_MAGIC
+        self._index = None
+        # the last small frame that was decompressed
+        self._frame = (None, None)
+        self._lock = threading.Lock()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.fh.close()
+
+    def index(self):
+        # basename -> CpioEntry, built in one pass that only reads headers
+        if self._index is None and self.compressed:
+            self._index = self._read_frame_index()
+        elif self._index is None:
+            members = dict()
+            self.fh.seek(0)
+            while True:
+                with CpioFile(self.fh) as f:
+                    if f.last():
+                        break
+                    members[os.path.basename(f.name.decode())] = CpioEntry(self.fh.tell(), f.c_filesize, f, None, None)
+                    f.skip()
+            self._index = members
+        return self._index
+
+    def _read_frame_index(self):
+        end = os.fstat(self.fh.fileno()).st_size - FOOTER.size
+        footer = FOOTER.unpack(os.pread(self.fh.fileno(), FOOTER.size, end))
+        if footer[0][:2] != GZIP_MAGIC or footer[5] != b'NM':
+            raise Exception("compressed cpio without frame index")
+        offset = footer[7]
+        js = json.loads(zlib.decompress(os.pread(self.fh.fileno(), end - offset, offset), 31))
+        if js.get("version") != 1:
+            raise Exception("Unsupported cpio frame index version")
+        frames = js["frames"]
+        members = dict()
+        for name, (frame, offset, size) in js["members"].items():
+            members[name] = CpioEntry(offset, size, None, frames[frame][0], frames[frame][1])
+        return members
+
+    def _stream_frame(self, entry):
+        # large members have a frame of their own, decompress them on the fly
+        start = entry.offset
+        end = entry.offset + entry.size
+        d = zlib.decompressobj(31)
+        pos = 0
+        for data in _pread_chunks(self.fh, entry.frame, entry.framesize):
+            data = d.decompress(data)
+            if pos + len(data) > start:
+                yield data[max(0, start - pos):end - pos]
+            pos += len(data)
+            if pos >= end:
+                break
+        if pos < end:
+            raise Exception("truncated frame at offset %d" % entry.frame)
+
+    def _small_frame(self, entry):
+        with self._lock:
+            frame, data = self._frame
+            if frame == entry.frame:
+                return data
+        data = zlib.decompress(os.pread(self.fh.fileno(), entry.framesize, entry.frame), 31)
+        with self._lock:
+            self._frame = (entry.frame, data)
+        return data
+
+    def names(self):
+        return sorted(self.index())
+
+    def digest(self, name, algo):
+        entry = self.index()[name]
+        if entry.frame is None:
+            return _hash_mapped(self.fh, algo, entry.offset, entry.size)
+        return _hash_chunks(self.stream(name), algo)
+
+    def lookup(self, name):
+        return self.index().get(name)
+
+    def stream(self, name, chunk_size=CHUNK_SIZE):
+        # positional reads, so several threads may stream from one reader
+        entry = self.index()[name]
+        if entry.frame is not None:
+            if entry.size >= FRAME_SIZE:
+                yield from self._stream_frame(entry)
+                return
+            data = memoryview(self._small_frame(entry))[entry.offset:entry.offset + entry.size]
+            for i in range(0, len(data), chunk_size):
+                yield data[i:i + chunk_size]
+            return
+        offset = entry.offset
+        end = entry.offset + entry.size
+        while offset < end:
+            data = os.pread(self.fh.fileno(), min(chunk_size, end - offset), offset)
+            if not data:
+                raise Exception("short read at offset %d" % offset)
+            offset += len(data)
+            yield data
+
+    def copy(self, name, ofh):
+        entry = self.index()[name]
+        if entry.frame is not None:
+            for data in self.stream(name):
+                ofh.write(data)
+            return
+        _copy_range(self.fh, ofh, entry.offset, entry.size)
+
+    def extract(self, outdir, names=None):
+        for name in (self.names() if names is None else names):
+            with open(os.path.join(outdir if outdir else '.', name), 'wb') as ofh:
+                self.copy(name, ofh)
+
+
+class GzipFrame:
+    # one gzip member put together from independently deflated segments, so
+    # that cpio headers get compressed while tarballs that are compressed
+    # already are only stored, at the speed of a copy
+    def __init__(self, fh):
+        self.fh = fh
+        self.start = fh.tell()
+        self.crc = 0
+        self.size = 0
+        self.level = None
+        self.segment = None
+        fh.write(GZIP_HEADER)
+
+    def begin(self, level):
+        # segments must not refer back to each other, so each one starts
+        # with a fresh compressor
+        if self.segment is not None and self.level == level:
+            return
+        self.end_segment()
+        self.level = level
+        self.segment = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    def write(self, data):
+        if self.segment is None:
+            self.begin(6)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.fh.write(self.segment.compress(data))
+
+    def end_segment(self):
+        if self.segment is not None:
+            self.fh.write(self.segment.flush(zlib.Z_SYNC_FLUSH))
+            self.segment = None
+
+    def close(self):
+        self.end_segment()
+        # empty final block and the gzip trailer
+        self.fh.write(b'\x03\x00' + struct.pack('<II', self.crc, self.size & 0xffffffff))
+        return self.fh.tell() - self.start
 
 class CpioWriter:
-    def __init__(self, fn):
+    def __init__(self, fn, compress=False, frame_size=FRAME_SIZE):
         self.cpio = open(fn, 'wb')
+        self.frame_size = frame_size
+        # (offset, compressed size) of every finished frame, None when the
+        # archive is written uncompressed
+        self.frames = [] if compress else None
+        # basename -> (frame, offset, size)
+        self.members = dict()
+        self.frame = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type:
+            self.cpio.close()
             return None
         self.add('TRAILER!!!', b'')
+        if self.frames is not None:
+            self._end_frame()
+            self._write_frame_index()
+        self.cpio.close()
         return self
 
+    def _write(self, data):
+        if self.frames is None:
+            self.cpio.write(data)
+            return
+        if self.frame is None:
+            self.frame = GzipFrame(self.cpio)
+        self.frame.write(data)
+
+    def _write_payload(self, chunks):
+        first = self.frames is not None
+        for data in chunks:
+            if first:
+                if self.frame is None:
+                    self.frame = GzipFrame(self.cpio)
+                self.frame.begin(0 if bytes(data[:6]).startswith(PRECOMPRESSED) else 6)
+                first = False
+            self._write(data)
+
+    def _end_frame(self):
+        if self.frame is None:
+            return
+        start = self.frame.start
+        self.frames.append((start, self.frame.close()))
+        self.frame = None
+
+    def _end_member(self, size):
+        if size % 4:
+            self._write(b'\0' * (4 - size % 4))
+        if self.frame is not None and self.frame.size >= self.frame_size:
+            self._end_frame()
+
+    def _write_frame_index(self):
+        offset = self.cpio.tell()
+        js = {"version": 1, "frames": self.frames, "members": self.members}
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.cpio.write(c.compress(json.dumps(js, sort_keys=True).encode()) + c.flush())
+        self.cpio.write(_gzip_footer(offset))
+
     def add(self, name, content, perm=0o644):
         if isinstance(name, str):
             name = name.encode()
@@ -131,21 +553,23 @@ class CpioWriter:
         header = b'070701%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%s' % (
             0, mode, 0, 0, 1, 0, size, 0, 0, 0, 0, len(name), 0, name)
 
-        self.cpio.write(header)
+        self._write(header)
         if len(header):
-            self.cpio.write(b'\0' * (4 - len(header) % 4))
-        self.cpio.write(content)
-        if size % 4:
-            self.cpio.write(b'\0' * (4 - size % 4))
+            self._write(b'\0' * (4 - len(header) % 4))
+        self._write(content)
+        self._end_member(size)
 
-    def addstream(self, name, fh):
+    def _header(self, name, size):
         if isinstance(name, str):
             name = name.encode()
+        if self.frames is not None and size >= self.frame_size:
+            # large members get a frame of their own
+            self._end_frame()
+        if self.frame is not None:
+            self.frame.begin(6)
+        basename = os.path.basename(name).decode()
         name += b'\0'
 
-        info = os.stat(fh.fileno())
-        size = info[stat.ST_SIZE]
-
         header = b'070701%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%s' % (
             0,  # inode
             0o644 | 0x8000, # MODE and regular file
@@ -163,12 +587,40 @@ class CpioWriter:
             name
             )
 
-        self.cpio.write(header)
+        self._write(header)
         if len(header) % 4:
-            self.cpio.write(b'\0' * (4 - len(header) % 4))
-        self.cpio.write(fh.read())
-        if size % 4:
-            self.cpio.write(b'\0' * (4 - size % 4))
+            self._write(b'\0' * (4 - len(header) % 4))
+        if self.frames is not None:
+            self.members[basename] = (len(self.frames), self.frame.size, size)
+
+    def addstream(self, name, fh):
+        info = os.stat(fh.fileno())
+        size = info[stat.ST_SIZE]
+
+        self._header(name, size)
+        if self.frames is None:
+            _copy_range(fh, self.cpio, fh.tell(), size)
+        else:
+            self._write_payload(_read_chunks(fh))
+        self._end_member(size)
+
+    def addrange(self, name, fh, offset, size):
+        # copy a member verbatim out of another, uncompressed archive
+        self._header(name, size)
+        if self.frames is None:
+            _copy_range(fh, self.cpio, offset, size)
+        else:
+            self._write_payload(_pread_chunks(fh, offset, size))
+        self._end_member(size)
+
+    def addfrom(self, reader, name):
+        entry = reader.lookup(name)
+        if entry.frame is None:
+            self.addrange(name, reader.fh, entry.offset, entry.size)
+            return
+        self._header(name, entry.size)
+        self._write_payload(reader.stream(name))
+        self._end_member(entry.size)
 
     def addfile(self, name):
         with open(name, 'rb') as fh:
@@ -183,11 +635,54 @@ def parse_supported_fetch_url(from_entry):
         from_entry = from_entry[end_name_pos+1:]
 
     o = urllib.parse.urlparse(from_entry)
-    if o.scheme in ("git+http", "git+https", "https"):
+    if o.scheme in ("git+file", "git+http", "git+https", "http", "https"):
         return o
     return False
 
-def add_git_dependency(o, module, install_path):
+class Dependency:
+    __slots__ = ("url", "algo", "chksum", "scm", "branch", "basename", "path", "order", "size")
+
+    def __init__(self, url, algo=None, chksum=None, scm=None, branch=None, basename=None, order=None, size=None):
+        self.url = url
+        self.algo = algo
+        self.chksum = chksum
+        self.scm = scm
+        self.branch = branch
+        self.basename = basename
+        # install paths. Most dependencies have only one or two, a tuple is
+        # a fraction of the size of a set then
+        self.path = ()
+        self.order = order
+        # tarball size if known from a manifest or an earlier download
+        self.size = size
+
+class DependencyTable:
+    # filename -> Dependency for one lockfile. compression is a hack for
+    # obs_scm integration, it decides the name of git tarballs
+    __slots__ = ("deps", "compression")
+
+    def __init__(self, compression=None):
+        self.deps = dict()
+        self.compression = compression
+
+    def __contains__(self, fn):
+        return fn in self.deps
+
+    def __getitem__(self, fn):
+        return self.deps[fn]
+
+    def __iter__(self):
+        return iter(self.deps)
+
+    def __len__(self):
+        return len(self.deps)
+
+    def add_path(self, fn, install_path):
+        dep = self.deps[fn]
+        if install_path not in dep.path:
+            dep.path += (install_path,)
+
+def add_git_dependency(table, o, module, install_path, order=None):
     _, scheme = o.scheme.split("+")
     branch = "master"
     # XXX: not sure that is correct
@@ -196,21 +691,27 @@ def add_git_dependency(o, module, install_path):
     p = os.path.basename(o.path)
     if p.endswith(".git"):
         p = p[:-4]
-    if OBS_SCM_COMPRESSION:
-        fn = "{}-{}.tar.{}".format(p, branch, OBS_SCM_COMPRESSION)
+    if table.compression:
+        fn = "{}-{}.tar.{}".format(p, branch, table.compression)
     else:
         fn = "{}-{}.tgz".format(p, branch)
-    MODULE_MAP[fn] = {
-        "scm": "git",
-        "branch": branch,
-        "basename": p,
-        "url": urllib.parse.urlunparse(
+    dep = Dependency(
+        urllib.parse.urlunparse(
             (scheme, o.netloc, o.path, o.params, o.query, None)
         ),
-    }
+        scm="git",
+        branch=sys.intern(branch),
+        basename=p,
+        order=order,
+    )
 
-    MODULE_MAP[fn].setdefault("path", set()).add(install_path)
-    return True
+    if fn not in table or _takes_precedence(table[fn], order):
+        if fn in table:
+            dep.path = table[fn].path
+        table.deps[fn] = dep
+
+    table.add_path(fn, install_path)
+    return fn
 
 def make_unique_fn_from_path(o):
     path = o.path.split('/')
@@ -225,7 +726,12 @@ def make_unique_fn_from_path(o):
 
     return '-'.join(prepended + [original_fn])
 
-def add_standard_dependency(o, integrities, module, install_path):
+def _takes_precedence(dep, order):
+    # with an order the entry of the first install path in sorted order wins
+    # conflicts, regardless of the order the lockfile is processed in
+    return order is not None and dep.order is not None and order < dep.order
+
+def add_standard_dependency(table, o, integrities, module, install_path, order=None):
     url = urllib.parse.urlunparse(o)
     # pick the longest integrity assuming it will be better (eg sha1 vs sha256)
     integrity = max(integrities.split(" "), key=len)
@@ -233,28 +739,35 @@ def add_standard_dependency(o, integrities, module, install_path):
     chksum = hexlify(b64decode(chksum)).decode("ascii")
     fn = make_unique_fn_from_path(o)
 
-    if fn in MODULE_MAP:
+    if fn in table:
+        dep = table[fn]
         if (
-            MODULE_MAP[fn]["url"] != url
-            or MODULE_MAP[fn]["algo"] != algo
-            or MODULE_MAP[fn]["chksum"] != chksum
+            dep.url != url
+            or dep.algo != algo
+            or dep.chksum != chksum
         ):
             logging.error(
                 "%s: mismatch %s <> %s, %s:%s <> %s:%s",
                 module,
-                MODULE_MAP[fn]["url"],
+                dep.url,
                 url,
-                MODULE_MAP[fn]["algo"],
-                MODULE_MAP[fn]["chksum"],
+                dep.algo,
+                dep.chksum,
                 algo,
                 chksum,
             )
+            if _takes_precedence(dep, order):
+                dep.url = url
+                dep.algo = algo
+                dep.chksum = chksum
+                dep.order = order
     else:
-        MODULE_MAP[fn] = {"url": url, "algo": algo, "chksum": chksum}
+        table.deps[fn] = Dependency(url, sys.intern(algo), chksum, order=order)
 
-    MODULE_MAP[fn].setdefault("path", set()).add(install_path)
+    table.add_path(fn, install_path)
+    return fn
 
-def fetch_non_resolved_dependency_location(entry, module, install_path):
+def fetch_non_resolved_dependency_location(table, entry, module, install_path, order=None):
     # format of the "from" field is in `npm-package-arg` NPM package
     labels = ["from", "version"]
     o = False
@@ -279,23 +792,23 @@ def fetch_non_resolved_dependency_location(entry, module, install_path):
         logging.warning("entry %s has no download", module)
         return False
 
-    if o.scheme == "https":
+    if o.scheme in ("http", "https"):
         integrity = entry["integrity"]
-        return add_standard_dependency(o, integrity, module, install_path)
+        return add_standard_dependency(table, o, integrity, module, install_path, order)
     elif o.scheme.startswith("git+"):
-        return add_git_dependency(o, module, install_path)
+        return add_git_dependency(table, o, module, install_path, order)
 
     return False
 
 
-def collect_v2_deps_recursive(d, deps):
+def collect_v2_deps_recursive(table, d, deps):
     for module in sorted(deps):
         path = "/".join(("node_modules", module))
         if d:
             path = "/".join((d, path))
         entry = deps[module]
         if "resolved" not in entry:
-            fetch_non_resolved_dependency_location(entry, module, path)
+            fetch_non_resolved_dependency_location(table, entry, module, path)
         else:
             url = entry["resolved"]
             if "integrity" not in entry:
@@ -303,13 +816,12 @@ def collect_v2_deps_recursive(d, deps):
                 integrity = 'NONE-'
             else:
                 integrity = entry["integrity"]
-            add_standard_dependency(parse_supported_fetch_url(url), integrity, module, path)
+            add_standard_dependency(table, parse_supported_fetch_url(url), integrity, module, path)
 
         if "dependencies" in entry:
-            collect_v2_deps_recursive(path, entry["dependencies"])
+            collect_v2_deps_recursive(table, path, entry["dependencies"])
 
-def process_module(module, packages):
-    entry = packages[module]
+def process_module(table, module, entry):
     pos = module.find('node_modules/')
     if pos == -1:
         # All node modules are still installed under `*/node_modules/` in some workspace or not
@@ -325,17 +837,16 @@ def process_module(module, packages):
     path = "/" + module
     module = module[:pos+13]
     if "resolved" not in entry:
-        fetch_non_resolved_dependency_location(entry, module, path)
+        return fetch_non_resolved_dependency_location(table, entry, module, path, path)
     else:
         url = entry["resolved"]
-        integrity = entry["integrity"]
         o = urllib.parse.urlparse(url)
         if o.scheme.startswith("git+"):
-            add_git_dependency(o, module, "/" + module)
+            return add_git_dependency(table, o, module, "/" + module, path)
         else:
-            add_standard_dependency(parse_supported_fetch_url(url), integrity, module, path)
+            return add_standard_dependency(table, parse_supported_fetch_url(url), entry["integrity"], module, path, path)
 
-def collect_v3_deps(packages):
+def collect_v3_deps(table, packages):
     deps = packages.keys()
     # workspaces = packages[""]["workspaces"]
     # print(workspaces)
@@ -343,26 +854,1256 @@ def collect_v3_deps(packages):
         if module == "":
             continue
 
-        process_module(module, packages)
+        process_module(table, module, packages[module])
 
-def write_rpm_sources(fh, args):
+def write_rpm_sources(fh, table, args):
     i = args.source_offset if args.source_offset is not None else ''
-    for fn in sorted(MODULE_MAP):
-        fh.write("Source{}:         {}#/{}\n".format(i, MODULE_MAP[fn]["url"], fn))
+    for fn in sorted(table):
+        fh.write("Source{}:         {}#/{}\n".format(i, table[fn].url, fn))
         if args.source_offset is not None:
             i += 1
 
-def process_packagelock_file(js):
+class JsonStream:
+    # minimal pull parser for huge json documents. It walks objects member by
+    # member and leaves decoding of the values to the stdlib decoder
+    def __init__(self, fh, chunk_size=1 << 20):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size):
+        data = self.fh.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill(self.chunk_size):
+                raise ValueError("unexpected end of json document")
+
+    def _expect(self, ch):
+        if self._peek() != ch:
+            raise ValueError("expected '%s' at offset %d" % (ch, self.pos))
+        self.pos += 1
+
+    def value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # grow geometrically so big values are not decoded over and over
+            self._fill(max(self.chunk_size, len(self.buf) - self.pos))
+
+    def members(self):
+        # yields the keys of an object, the caller has to consume each value
+        # with value() or members() before asking for the next key
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            ch = self._peek()
+            self.pos += 1
+            if ch == '}':
+                return
+            if ch != ',':
+                raise ValueError("expected ',' or '}' at offset %d" % (self.pos - 1))
+
+def stream_packagelock_file(table, fh, resolved=None):
+    # v3 packages are resolved while they are read. Anything that cannot be
+    # streamed is collected and resolved the usual way at the end
+    stream = JsonStream(fh)
+    js = dict()
+    streamed = False
+    for key in stream.members():
+        if key == "packages" and "name" in js and js.get("lockfileVersion") == 3:
+            for module in stream.members():
+                entry = stream.value()
+                if module != "":
+                    fn = process_module(table, module, entry)
+                    if fn and resolved:
+                        resolved(fn)
+            streamed = True
+        else:
+            js[key] = stream.value()
+
+    if streamed:
+        return
+    if "name" in js:
+        process_packagelock_file(table, js)
+    else:
+        for i in js.keys():
+            process_packagelock_file(table, js[i])
+
+def _is_ndjson(fn):
+    return fn.endswith((".ndjson", ".jsonl"))
+
+def write_manifest(fh, table, ndjson=False):
+    # the resolved table in a form other tools can fetch from
+    records = []
+    for fn in sorted(table):
+        dep = table[fn]
+        record = {"filename": fn, "url": dep.url, "paths": sorted(dep.path)}
+        if dep.scm:
+            record.update(scm=dep.scm, branch=dep.branch, basename=dep.basename)
+        else:
+            record.update(algo=dep.algo, checksum=dep.chksum)
+        if dep.size is not None:
+            record.update(size=dep.size)
+        records.append(record)
+
+    if ndjson:
+        for record in records:
+            fh.write(json.dumps(record, sort_keys=True) + "\n")
+    else:
+        json.dump({"manifestVersion": 1, "dependencies": records}, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+
+def read_manifest(table, fh, ndjson=False):
+    if ndjson:
+        records = (json.loads(line) for line in fh if line.strip())
+    else:
+        js = json.load(fh)
+        if js.get("manifestVersion") != 1:
+            raise Exception("Unsupported manifest version")
+        records = js["dependencies"]
+
+    for record in records:
+        dep = Dependency(
+            record["url"],
+            record.get("algo"),
+            record.get("checksum"),
+            record.get("scm"),
+            record.get("branch"),
+            record.get("basename"),
+            size=record.get("size"),
+        )
+        dep.path = tuple(record["paths"])
+        table.deps[record["filename"]] = dep
+
+def process_packagelock_file(table, js):
     if not "lockfileVersion" in js:
         raise Exception("Only package-lock.json with lockfileVersion=2+ are supported")
     elif js["lockfileVersion"] == 2:
-        collect_v2_deps_recursive("", js["dependencies"])
+        collect_v2_deps_recursive(table, "", js["dependencies"])
     elif js["lockfileVersion"] == 3:
-        collect_v3_deps(js["packages"])
+        collect_v3_deps(table, js["packages"])
     else:
         raise Exception("Unsupported lockfileVersion found")
 
-def main(args):
+def _unlink_quiet(fn):
+    try:
+        os.unlink(fn)
+    except FileNotFoundError:
+        pass
+
+def _same_content(a, b):
+    try:
+        fa, fb = open(a, "rb"), open(b, "rb")
+    except FileNotFoundError:
+        return False
+    with fa, fb:
+        if os.fstat(fa.fileno()).st_size != os.fstat(fb.fileno()).st_size:
+            return False
+        while True:
+            chunk = fa.read(CHUNK_SIZE)
+            if chunk != fb.read(CHUNK_SIZE):
+                return False
+            if not chunk:
+                return True
+
+def _replace_if_changed(newfn, fn, current):
+    # unchanged files keep their mtime, so osc doesn't see a modification.
+    # current is the file as it is now, with --outdir it is not written there
+    if _same_content(newfn, current):
+        logging.info("%s is unchanged", current)
+        os.unlink(newfn)
+        return False
+    os.rename(newfn, fn)
+    return True
+
+def _write_if_changed(fn, content, current):
+    try:
+        with open(current) as fh:
+            if fh.read() == content:
+                logging.info("%s is unchanged", current)
+                return False
+    except FileNotFoundError:
+        pass
+    with open(fn + ".new", "w") as fh:
+        fh.write(content)
+    os.rename(fn + ".new", fn)
+    return True
+
+def _archive_unchanged(table, old_cpio, compress, outfn):
+    # a cheap look at the index: the previous archive has exactly the
+    # tarballs of the table and none of them would be fetched again
+    if old_cpio.compressed != compress:
+        return False
+    if old_cpio.names() != sorted(os.path.basename(fn) for fn in table):
+        return False
+    for fn in table:
+        if table[fn].scm and table[fn].branch == "master" or os.path.exists(outfn(fn)):
+            return False
+    return True
+
+def _hash_chunks(chunks, algo):
+    h = hashlib.new(algo)
+    for data in chunks:
+        h.update(data)
+    return h.hexdigest()
+
+def _read_chunks(fh):
+    while True:
+        data = fh.read(CHUNK_SIZE)
+        if not data:
+            break
+        yield data
+
+def _hash_mapped(fh, algo, offset=0, size=None):
+    # hashed in one call, large files straight from the page cache. hashlib
+    # drops the GIL for the whole buffer, so threads hashing files use all
+    # cores
+    if size is None:
+        size = os.fstat(fh.fileno()).st_size - offset
+    h = hashlib.new(algo)
+    if not size or size < MMAP_MIN:
+        h.update(os.pread(fh.fileno(), size, offset))
+    else:
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(fh.fileno(), offset + size - start, access=mmap.ACCESS_READ, offset=start) as m:
+            with memoryview(m)[offset - start:] as view:
+                h.update(view)
+    return h.hexdigest()
+
+def _hash_file(fn, algo, metrics=None):
+    start = time.perf_counter()
+    with open(fn, 'rb') as fh:
+        digest = _hash_mapped(fh, algo)
+        if metrics is not None:
+            metrics.hashed(os.fstat(fh.fileno()).st_size, time.perf_counter() - start)
+    return digest
+
+def verify_existing(fn, entry, outfn, archive=None, metrics=None):
+    # hash a file already present in the outdir or the old archive against
+    # the lockfile checksum. None if there is nothing to check
+    if entry.algo not in hashlib.algorithms_available:
+        return None
+    if os.path.exists(outfn):
+        digest = _hash_file(outfn, entry.algo, metrics)
+    elif archive is not None and archive.lookup(fn) is not None:
+        start = time.perf_counter()
+        digest = archive.digest(fn, entry.algo)
+        if metrics is not None:
+            metrics.hashed(archive.lookup(fn).size, time.perf_counter() - start)
+    else:
+        return None
+    return digest == entry.chksum
+
+def _link_or_clone(src, dst):
+    _unlink_quiet(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    # different file system or no hardlinks, try a reflink before copying
+    with open(src, 'rb') as ifh, open(dst, 'wb') as ofh:
+        try:
+            fcntl.ioctl(ofh.fileno(), FICLONE, ifh.fileno())
+        except OSError:
+            shutil.copyfileobj(ifh, ofh, CHUNK_SIZE)
+
+def parse_size(s):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    s = s.strip().upper().rstrip('B')
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+class TarballCache:
+    # tarballs stored as <dir>/<algo>/<xx>/<chksum>, the mtime is bumped on
+    # every use and serves as LRU stamp for eviction
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+
+    def _path(self, algo, chksum):
+        return os.path.join(self.path, algo, chksum[:2], chksum)
+
+    def lookup(self, algo, chksum, outfn, metrics=None):
+        fn = self._path(algo, chksum)
+        if not os.path.exists(fn):
+            return False
+        if _hash_file(fn, algo, metrics) != chksum:
+            logging.warning("removing corrupt cache entry %s", fn)
+            _unlink_quiet(fn)
+            return False
+        _link_or_clone(fn, outfn + ".new")
+        os.rename(outfn + ".new", outfn)
+        os.utime(fn)
+        return True
+
+    def store(self, algo, chksum, src):
+        fn = self._path(algo, chksum)
+        if os.path.exists(fn):
+            os.utime(fn)
+            return
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp = "%s.%d.%d.new" % (fn, os.getpid(), threading.get_ident())
+        try:
+            _link_or_clone(src, tmp)
+            os.rename(tmp, fn)
+        except OSError as e:
+            logging.warning("failed to cache %s: %s", src, e)
+            _unlink_quiet(tmp)
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                fn = os.path.join(root, f)
+                try:
+                    st = os.stat(fn)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fn))
+                total += st.st_size
+        for _, size, fn in sorted(entries):
+            if total <= self.max_size:
+                break
+            logging.debug("evicting %s from cache", fn)
+            _unlink_quiet(fn)
+            total -= size
+
+def _parse_retry_after(value):
+    import email.utils
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        stamp = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, stamp.timestamp() - time.time())
+
+class TokenBucket:
+    # global download bandwidth limit. Callers take what they need and sleep
+    # off the debt, which keeps the average at rate bytes per second
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst else max(rate, CHUNK_SIZE)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n):
+        # seconds to wait before using n bytes
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def consume(self, n):
+        wait = self.reserve(n)
+        if wait:
+            time.sleep(wait)
+
+class FetchScheduler:
+    # decides which of the waiting fetches may start. The largest known
+    # download goes first so big tarballs do not end up as the tail of the
+    # run, and no more than per_host of them talk to the same host at a time
+    def __init__(self, jobs, per_host=None):
+        self.jobs = jobs
+        self.per_host = per_host if per_host else jobs
+        # host -> heap of (-size, sequence, future)
+        self.queues = dict()
+        self.active = collections.Counter()
+        self.running = 0
+        self.sequence = itertools.count()
+
+    async def run(self, host, size, fn, *args):
+        ready = asyncio.get_event_loop().create_future()
+        queue = self.queues.setdefault(host, [])
+        heapq.heappush(queue, (-(size or 0), next(self.sequence), ready))
+        self._dispatch()
+        try:
+            await ready
+        except asyncio.CancelledError:
+            if ready.done() and not ready.cancelled():
+                self._release(host)
+            raise
+        try:
+            return await fn(*args)
+        finally:
+            self._release(host)
+
+    def _release(self, host):
+        self.active[host] -= 1
+        self.running -= 1
+        self._dispatch()
+
+    def _next(self):
+        best = None
+        for host, queue in self.queues.items():
+            if self.active[host] < self.per_host and (best is None or queue[0] < self.queues[best][0]):
+                best = host
+        return best
+
+    def _dispatch(self):
+        while self.running < self.jobs:
+            host = self._next()
+            if host is None:
+                return
+            queue = self.queues[host]
+            _, _, ready = heapq.heappop(queue)
+            if not queue:
+                del self.queues[host]
+            if ready.cancelled():
+                continue
+            self.active[host] += 1
+            self.running += 1
+            ready.set_result(None)
+
+class TarballFetcher:
+    # outcome of a single request
+    OK, RETRY, FAILED = range(3)
+
+    def __init__(self, jobs, cache=None, timeout=None, retries=0, registry=None, mirrors=(), metrics=None, rate=None):
+        self.cache = cache
+        self.bucket = TokenBucket(rate) if rate else None
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.retries = retries
+        self.registry = registry.rstrip('/') + '/' if registry else None
+        self.mirrors = [m.rstrip('/') + '/' for m in mirrors]
+        # where files are hashed off the event loop, None is the default
+        # executor of the loop
+        self.hash_executor = None
+        self.http = self._pool(jobs, timeout)
+
+    def _pool(self, jobs, timeout):
+        if urllib3 is None:
+            raise Exception("downloading needs urllib3 or aiohttp")
+        # one keep-alive pool per registry host, large enough that every
+        # worker thread can hold on to its connection
+        return urllib3.PoolManager(
+            maxsize=jobs,
+            timeout=urllib3.Timeout(connect=timeout, read=timeout),
+            retries=urllib3.Retry(total=None, connect=0, read=0, redirect=5),
+        )
+
+    def candidates(self, url):
+        # registry urls are tried on the mirrors first, in the given order
+        if self.registry and self.mirrors and url.startswith(self.registry):
+            path = url[len(self.registry):]
+            return [m + path for m in self.mirrors] + [url]
+        return [url]
+
+    def _prepare(self, fn, entry, outfn, download_always):
+        # request headers, or None if there is nothing to download
+        headers = {}
+        if os.path.exists(outfn):
+            if not download_always:
+                logging.info("skipping download of existing %s", fn)
+                self.metrics.count("skipped")
+                return None
+            stamp = time.strftime(
+                "%a, %d %b %Y %H:%M:%S GMT", time.gmtime(os.path.getmtime(outfn))
+            )
+            logging.debug("adding If-Modified-Since %s: %s", fn, stamp)
+            headers["If-Modified-Since"] = stamp
+
+        if self.cache:
+            if self.cache.lookup(entry.algo, entry.chksum, outfn, self.metrics):
+                logging.info("using cached %s", fn)
+                self._count("cached")
+                return None
+            self._count("cache_misses")
+        return headers
+
+    def _delay(self, fn, attempt, retry_after):
+        if retry_after is None:
+            # exponential backoff with full jitter
+            retry_after = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        # a server asking for hours must not stall the whole run
+        retry_after = min(retry_after, BACKOFF_MAX)
+        logging.info("retrying %s in %.1fs", fn, retry_after)
+        self._count("retries")
+        return retry_after
+
+    def _failed(self, fn):
+        logging.error("failed to fetch %s", fn)
+        self._count("failed")
+        return False
+
+    def _attempts(self, fn, url):
+        # retries and mirror failover for both transports. Yields the url to
+        # get next and takes the outcome of that request, or yields the
+        # seconds to wait before the next round. Returns whether the tarball
+        # got fetched
+        urls = self.candidates(url)
+        for attempt in range(self.retries + 1):
+            delay = None
+            for url in list(urls):
+                result, retry_after = yield url
+                if result == self.OK:
+                    return True
+                if result == self.FAILED:
+                    urls.remove(url)
+                elif retry_after is not None:
+                    delay = max(delay or 0, retry_after)
+            if not urls or attempt == self.retries:
+                break
+            yield self._delay(fn, attempt, delay)
+
+        return self._failed(fn)
+
+    def fetch(self, fn, entry, outfn, download_always):
+        headers = self._prepare(fn, entry, outfn, download_always)
+        if headers is None:
+            return True
+
+        attempts = self._attempts(fn, entry.url)
+        step = next(attempts)
+        try:
+            while True:
+                if isinstance(step, str):
+                    step = attempts.send(self._get(fn, entry, step, headers, outfn))
+                else:
+                    time.sleep(step)
+                    step = next(attempts)
+        except StopIteration as e:
+            return e.value
+
+    def _status(self, fn, url, response):
+        # outcome of anything but 200. The caller read the body, so the
+        # connection can be reused
+        if response.status == 304:
+            logging.info("%s not modified", fn)
+            return self.OK, None
+        logging.warning("HTTP Error %d: %s for %s", response.status, response.reason, url)
+        if response.status in RETRY_STATUS:
+            return self.RETRY, _parse_retry_after(response.headers.get("Retry-After"))
+        return self.FAILED, None
+
+    def _error(self, url, outfn, e, result):
+        # network errors are worth another try, local ones are not
+        logging.log(logging.WARNING if result == self.RETRY else logging.ERROR, "%s: %s", url, e)
+        _unlink_quiet(outfn + ".new")
+        return result, None
+
+    def _get(self, fn, entry, url, headers, outfn):
+        logging.info("fetching %s as %s", url, fn)
+        h = hashlib.new(entry.algo)
+        hashing = 0
+        size = 0
+        start = time.perf_counter()
+        try:
+            response = self.http.request(
+                "GET", url, headers=headers, preload_content=False, decode_content=False
+            )
+        except urllib3.exceptions.HTTPError as e:
+            return self._error(url, outfn, e, self.RETRY)
+        latency = time.perf_counter() - start
+        try:
+            if response.status != 200:
+                response.read()
+                return self._status(fn, url, response)
+            with open(outfn + ".new", "wb") as fh:
+                for data in response.stream(CHUNK_SIZE, decode_content=False):
+                    if self.bucket:
+                        self.bucket.consume(len(data))
+                    t = time.perf_counter()
+                    h.update(data)
+                    hashing += time.perf_counter() - t
+                    size += len(data)
+                    fh.write(data)
+        except urllib3.exceptions.HTTPError as e:
+            return self._error(url, outfn, e, self.RETRY)
+        except OSError as e:
+            return self._error(url, outfn, e, self.FAILED)
+        finally:
+            response.release_conn()
+        self.metrics.download(fn, latency, time.perf_counter() - start, size)
+        self.metrics.hashed(size, hashing)
+        return self._finish(fn, entry, outfn, h.hexdigest(), size), None
+
+    def _finish(self, fn, entry, outfn, digest, size):
+        if digest != entry.chksum:
+            logging.error(
+                "checksum failure for %s %s %s %s",
+                fn,
+                entry.algo,
+                digest,
+                entry.chksum,
+            )
+            os.unlink(outfn + ".new")
+            return self.FAILED
+
+        os.rename(outfn + ".new", outfn)
+        entry.size = size
+        self._count("fetched")
+        if self.cache:
+            self.cache.store(entry.algo, entry.chksum, outfn)
+        return self.OK
+
+    def _count(self, what):
+        self.metrics.count(what)
+
+    def log_stats(self):
+        for key in self.http.pools.keys():
+            pool = self.http.pools[key]
+            logging.debug(
+                "%s://%s: %d requests over %d connections",
+                pool.scheme,
+                pool.host,
+                pool.num_requests,
+                pool.num_connections,
+            )
+
+class AsyncTarballFetcher(TarballFetcher):
+    # the same over aiohttp, with as many requests in flight as the
+    # scheduler lets through. Blocking file system work runs on a thread
+    def _pool(self, jobs, timeout):
+        self.jobs = jobs
+        self.timeout = timeout
+        # with more than one core downloads are hashed on the hash executor
+        # instead of on the event loop
+        self.offload = (os.cpu_count() or 1) > 1
+        self.session = None
+        # (scheme, host) -> [requests, connections]
+        self.stats = collections.defaultdict(lambda: [0, 0])
+        return None
+
+    async def open(self):
+        # imported here, it takes longer than the rest of the script
+        import aiohttp
+        trace = aiohttp.TraceConfig()
+
+        async def request_start(session, ctx, params):
+            ctx.key = (params.url.scheme, params.url.host)
+            self.stats[ctx.key][0] += 1
+
+        async def connection_created(session, ctx, params):
+            self.stats[ctx.key][1] += 1
+
+        trace.on_request_start.append(request_start)
+        trace.on_connection_create_end.append(connection_created)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.jobs),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+            auto_decompress=False,
+            # the bytes are hashed as they come, the same as with urllib3
+            headers={"Accept-Encoding": "identity"},
+            trace_configs=[trace],
+        )
+
+    async def close(self):
+        await self.session.close()
+
+    async def fetch(self, fn, entry, outfn, download_always):
+        if self.cache:
+            # looking up the cache means hashing
+            loop = asyncio.get_event_loop()
+            headers = await loop.run_in_executor(self.hash_executor, self._prepare, fn, entry, outfn, download_always)
+        else:
+            headers = self._prepare(fn, entry, outfn, download_always)
+        if headers is None:
+            return True
+
+        attempts = self._attempts(fn, entry.url)
+        step = next(attempts)
+        try:
+            while True:
+                if isinstance(step, str):
+                    step = attempts.send(await self._get(fn, entry, step, headers, outfn))
+                else:
+                    await asyncio.sleep(step)
+                    step = next(attempts)
+        except StopIteration as e:
+            return e.value
+
+    async def _get(self, fn, entry, url, headers, outfn):
+        import aiohttp
+        logging.info("fetching %s as %s", url, fn)
+        h = None if self.offload else hashlib.new(entry.algo)
+        hashing = 0
+        size = 0
+        start = time.perf_counter()
+        try:
+            async with self.session.get(url, headers=headers) as response:
+                latency = time.perf_counter() - start
+                if response.status != 200:
+                    await response.read()
+                    return self._status(fn, url, response)
+                with open(outfn + ".new", "wb") as fh:
+                    async for data in response.content.iter_chunked(CHUNK_SIZE):
+                        if self.bucket:
+                            await asyncio.sleep(self.bucket.reserve(len(data)))
+                        if h is not None:
+                            t = time.perf_counter()
+                            h.update(data)
+                            hashing += time.perf_counter() - t
+                        size += len(data)
+                        fh.write(data)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return self._error(url, outfn, e, self.RETRY)
+        except OSError as e:
+            return self._error(url, outfn, e, self.FAILED)
+        self.metrics.download(fn, latency, time.perf_counter() - start, size)
+        loop = asyncio.get_event_loop()
+        if h is None:
+            # hashed from the file on a worker thread, which keeps the event
+            # loop free for the transfers
+            return await loop.run_in_executor(self.hash_executor, self._check, fn, entry, outfn, size), None
+        self.metrics.hashed(size, hashing)
+        if self.cache:
+            # storing may have to copy the file
+            return await loop.run_in_executor(None, self._finish, fn, entry, outfn, h.hexdigest(), size), None
+        return self._finish(fn, entry, outfn, h.hexdigest(), size), None
+
+    def _check(self, fn, entry, outfn, size):
+        return self._finish(fn, entry, outfn, _hash_file(outfn + ".new", entry.algo, self.metrics), size)
+
+    def log_stats(self):
+        for (scheme, host), (requests, connections) in sorted(self.stats.items()):
+            logging.debug("%s://%s: %d requests over %d connections", scheme, host, requests, connections)
+
+class GitMirrorCache:
+    # mirror clones keyed by normalized url, each one is updated at most once
+    # per run no matter how many dependencies point to it
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._locks = dict()
+        self._updated = set()
+
+    @staticmethod
+    def key(url):
+        o = urllib.parse.urlparse(url)
+        path = o.path.rstrip('/')
+        if path.endswith(".git"):
+            path = path[:-4]
+        normalized = "{}://{}{}".format(o.scheme.lower(), o.hostname or '', path)
+        digest = hashlib.sha256(normalized.encode()).hexdigest()[:16]
+        return "{}-{}.git".format(os.path.basename(path), digest)
+
+    def mirror(self, url):
+        import subprocess
+        key = self.key(url)
+        d = os.path.join(self.path, key)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key in self._updated:
+                return d
+            os.makedirs(self.path, exist_ok=True)
+            # the thread lock covers this process, the file lock other runs
+            # sharing the cache
+            with open(d + ".lock", "w") as lockfh:
+                fcntl.flock(lockfh, fcntl.LOCK_EX)
+                if os.path.exists(d):
+                    logging.info("updating mirror of %s", url)
+                    r = subprocess.run(["git", "remote", "update", "--prune"], cwd=d)
+                else:
+                    logging.info("cloning %s", url)
+                    tmp = "%s.%d.%d.new" % (d, os.getpid(), threading.get_ident())
+                    r = subprocess.run(["git", "clone", "--mirror", url, tmp])
+                    if r.returncode:
+                        shutil.rmtree(tmp, ignore_errors=True)
+                    else:
+                        os.rename(tmp, d)
+            if r.returncode:
+                logging.error("failed to clone %s", url)
+                return None
+            self._updated.add(key)
+            return d
+
+def fetch_git(mirrors, fn, entry, outfn, compression=None):
+    import subprocess
+    d = mirrors.mirror(entry.url)
+    if d is None:
+        return False
+    outfn = os.path.abspath(outfn)
+    r = subprocess.run(
+        [
+            "git",
+            "archive",
+            "--format=tar." + (compression if compression else 'gz'),
+            "-o",
+            outfn + ".new",
+            "--prefix",
+            "package/",
+            entry.branch,
+        ],
+        cwd=d,
+    )
+    if r.returncode:
+        logging.error("failed to create tar %s", entry.url)
+        _unlink_quiet(outfn + ".new")
+        return False
+    os.rename(outfn + ".new", outfn)
+    return True
+
+class Fetcher:
+    # the asynchronous fetch core behind fetch() and the command line.
+    # Tarballs and git dependencies are scheduled in separate lanes, git
+    # runs on threads as it is a subprocess anyway
+    def __init__(self, jobs=8, cache=None, git_mirrors=None, timeout=None, retries=3,
+                 registry=DEFAULT_REGISTRY, mirrors=(), max_per_host=None, max_rate=None,
+                 git_jobs=None, metrics=None, transport=None):
+        import concurrent.futures
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.cache = cache
+        self.git_mirrors = git_mirrors if git_mirrors else GitMirrorCache('.')
+        if transport is None:
+            transport = "aiohttp" if importlib.util.find_spec("aiohttp") else "urllib3"
+        cls = AsyncTarballFetcher if transport == "aiohttp" else TarballFetcher
+        self.fetcher = cls(jobs, cache, timeout, retries, registry, mirrors, self.metrics, max_rate)
+        # without aiohttp the blocking fetcher runs on threads
+        self.executor = None
+        if cls is TarballFetcher:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        # one thread per core for hashing files, see _hash_mapped
+        self.hash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        self.fetcher.hash_executor = self.hash_executor
+        git_jobs = git_jobs if git_jobs else jobs
+        self.git_executor = concurrent.futures.ThreadPoolExecutor(max_workers=git_jobs)
+        self.scheduler = FetchScheduler(jobs, max_per_host)
+        self.git_scheduler = FetchScheduler(git_jobs, max_per_host)
+
+    async def __aenter__(self):
+        if self.executor is None:
+            await self.fetcher.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.executor is None:
+            await self.fetcher.close()
+        else:
+            self.executor.shutdown()
+        self.git_executor.shutdown()
+        self.hash_executor.shutdown()
+        self.fetcher.log_stats()
+
+    async def fetch(self, fn, entry, outfn, download_always=False, compression=None):
+        host = urllib.parse.urlparse(entry.url).netloc
+        if entry.scm:
+            return await self.git_scheduler.run(host, None, self._git, fn, entry, outfn, download_always, compression)
+        return await self.scheduler.run(host, entry.size, self._tarball, fn, entry, outfn, download_always)
+
+    async def _tarball(self, fn, entry, outfn, download_always):
+        if self.executor is None:
+            return await self.fetcher.fetch(fn, entry, outfn, download_always)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.fetcher.fetch, fn, entry, outfn, download_always)
+
+    def _fetch_git(self, fn, entry, outfn, download_always, compression):
+        if entry.branch != "master" and os.path.exists(outfn) and not download_always:
+            logging.info("skipping update of existing %s", outfn)
+            self.metrics.count("skipped")
+            return True
+        with self.metrics.timer("git"):
+            ok = fetch_git(self.git_mirrors, fn, entry, outfn, compression)
+        if not ok:
+            self.metrics.count("failed")
+        return ok
+
+    async def _git(self, fn, entry, outfn, download_always, compression):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.git_executor, self._fetch_git, fn, entry, outfn, download_always, compression)
+
+def fetch_options(args):
+    # Fetcher arguments from the command line
+    return dict(
+        jobs=args.jobs,
+        timeout=args.timeout,
+        retries=args.retries,
+        registry=args.registry,
+        mirrors=args.mirror or (),
+        max_per_host=args.max_per_host,
+        max_rate=parse_size(args.max_rate) if args.max_rate else None,
+        git_jobs=args.git_jobs,
+    )
+
+async def resolve(lockfile, compression=None, stream=False, metrics=None):
+    table = DependencyTable(compression)
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, read_packagelock, table, lockfile, stream, None, metrics)
+    return table
+
+async def fetch(table, outdir=".", cache=None, files=None, download_always=False, **options):
+    # downloads the tarballs and git dependencies of table to outdir and
+    # returns filename -> whether it is there now. cache is a directory or
+    # a TarballCache, the other options are the ones of Fetcher
+    if isinstance(cache, str):
+        cache = TarballCache(cache)
+    names = [fn for fn in table if not files or fn in files]
+    async with Fetcher(cache=cache, **options) as fetcher:
+        results = await asyncio.gather(*[
+            fetcher.fetch(fn, table[fn], os.path.join(outdir, fn), download_always, table.compression)
+            for fn in names
+        ])
+    return dict(zip(names, results))
+
+def _run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+class EventLoopThread:
+    # an event loop on a thread of its own, for callers that are not async
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+class DownloadPipeline:
+    # dependencies are queued as soon as they are resolved and can then be
+    # waited for one by one, eg. to add them to the archive in sorted order.
+    # The fetches run on a Fetcher on an event loop thread
+    def __init__(self, args, table, outfn, old_cpio=None, mirrors=None, metrics=None):
+        self.args = args
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.table = table
+        self.outfn = outfn
+        self.old_cpio = old_cpio
+        if old_cpio is not None:
+            # build the index before the workers look things up
+            old_cpio.index()
+        self.cache = None
+        if args.cache:
+            self.cache = TarballCache(args.cache, parse_size(args.cache_size) if args.cache_size else None)
+        if not mirrors:
+            mirrors = GitMirrorCache(args.git_cache if args.git_cache else '.')
+        self.fetcher = Fetcher(cache=self.cache, git_mirrors=mirrors, metrics=self.metrics, **fetch_options(args))
+        self.loop = EventLoopThread()
+        self.loop.run(self.fetcher.__aenter__())
+        # fn -> (future, (url, checksum) it was scheduled with)
+        self.pending = dict()
+        # existing tarballs that passed or failed verification
+        self.verified = set()
+        self.rejected = set()
+        self._lock = threading.Lock()
+
+    def archived(self, fn):
+        return self.old_cpio is not None and fn not in self.rejected and self.old_cpio.lookup(fn) is not None
+
+    def schedule(self, fn):
+        if self.args.file and fn not in self.args.file:
+            return
+        entry = self.table[fn]
+        key = (entry.url, entry.chksum)
+        if fn in self.pending:
+            future, scheduled = self.pending[fn]
+            if scheduled == key:
+                return
+            # a conflicting duplicate later in the lockfile took precedence
+            future.result()
+            _unlink_quiet(self.outfn(fn))
+        if not entry.scm and entry.size is None and self.old_cpio is not None and self.old_cpio.lookup(fn) is not None:
+            # the previous archive knows how big it was last time
+            entry.size = self.old_cpio.lookup(fn).size
+        future = self.loop.submit(self._git(fn, entry) if entry.scm else self._tarball(fn, entry))
+        self.pending[fn] = (future, key)
+
+    def wait(self, fn):
+        if fn in self.pending:
+            return self.pending[fn][0].result()
+
+    def finish(self):
+        for fn in sorted(self.pending):
+            self.wait(fn)
+        self.loop.run(self.fetcher.__aexit__(None, None, None))
+        self.loop.close()
+        if self.cache:
+            self.cache.evict()
+        if self.args.verify_local:
+            logging.info(
+                "verified local files: %d reused, %d failed, %d fetched",
+                len(self.verified),
+                len(self.rejected),
+                self.metrics.counters["fetched"],
+            )
+
+    async def _git(self, fn, entry):
+        if entry.branch != "master" and self.archived(fn):
+            logging.info("keeping %s from %s", fn, self.args.cpio)
+            self.metrics.count("skipped")
+            return True
+        return await self.fetcher.fetch(fn, entry, self.outfn(fn), self.args.download_always, self.table.compression)
+
+    def _verify(self, fn, entry, outfn):
+        ok = verify_existing(fn, entry, outfn, self.old_cpio, self.metrics)
+        if ok:
+            logging.info("keeping verified %s", fn)
+            self.metrics.count("skipped")
+            with self._lock:
+                self.verified.add(fn)
+        elif ok is False:
+            logging.warning("checksum failure for existing %s", fn)
+            with self._lock:
+                self.rejected.add(fn)
+            _unlink_quiet(outfn)
+        return ok
+
+    async def _tarball(self, fn, entry):
+        outfn = self.outfn(fn)
+        if self.args.verify_local:
+            loop = asyncio.get_event_loop()
+            ok = await loop.run_in_executor(self.fetcher.hash_executor, self._verify, fn, entry, outfn)
+            if ok:
+                return True
+            if ok is False:
+                return await self.fetcher.fetch(fn, entry, outfn, False)
+        if self.archived(fn) and not os.path.exists(outfn):
+            logging.info("keeping %s from %s", fn, self.args.cpio)
+            self.metrics.count("skipped")
+            return True
+        return await self.fetcher.fetch(fn, entry, outfn, self.args.download_always)
+
+def find_packagelock(args):
+    pattern = f"*{args.input}"
+    return next(reversed(sorted(Path(Path.cwd()).glob(pattern))), None)
+
+def read_packagelock(table, input_file, stream=False, resolved=None, metrics=None):
+    metrics = metrics if metrics is not None else Metrics()
+    with open(input_file) as fh:
+        if stream:
+            # resolved while parsing, there is no separate resolve phase
+            with metrics.timer("parse"):
+                stream_packagelock_file(table, fh, resolved)
+            return
+        with metrics.timer("parse"):
+            js = json.load(fh)
+        with metrics.timer("resolve"):
+            if "name" in js:
+                process_packagelock_file(table, js)
+            else:
+                for i in js.keys():
+                    process_packagelock_file(table, js[i])
+
+def resolve_cache_path(args, input_file):
+    # everything that influences the resolved table goes into the key
+    key = "{}\0{}\0{}".format(
+        RESOLVE_CACHE_VERSION,
+        args.compression or '',
+        _hash_file(input_file, "sha256"),
+    )
+    return os.path.join(args.resolve_cache, hashlib.sha256(key.encode()).hexdigest() + ".ndjson")
+
+def load_dependencies(table, args, resolved=None, metrics=None):
+    metrics = metrics if metrics is not None else Metrics()
+    if args.manifest:
+        with open(args.manifest) as fh, metrics.timer("parse"):
+            read_manifest(table, fh, _is_ndjson(args.manifest))
+        return
+
+    input_file = find_packagelock(args)
+    cached = None
+    if args.resolve_cache:
+        cached = resolve_cache_path(args, input_file)
+        if os.path.exists(cached):
+            logging.debug("using cached resolution %s", cached)
+            metrics.count("resolve_cached")
+            with open(cached) as fh, metrics.timer("parse"):
+                read_manifest(table, fh, ndjson=True)
+            return
+
+    read_packagelock(table, input_file, args.stream_lockfile, resolved, metrics)
+
+    if cached:
+        os.makedirs(args.resolve_cache, exist_ok=True)
+        tmp = "%s.%d.new" % (cached, os.getpid())
+        with open(tmp, "w") as fh:
+            write_manifest(fh, table, ndjson=True)
+        os.rename(tmp, cached)
+
+def _read_service(fn):
+    # lxml if available, only the standard library otherwise
+    try:
+        from lxml import etree
+    except ImportError:
+        import xml.etree.ElementTree as etree
+
+        class TreeBuilder(etree.TreeBuilder):
+            # keeps comments, insert_comments needs Python 3.8
+            def comment(self, data):
+                self.start(etree.Comment, {})
+                self.data(data)
+                return self.end(etree.Comment)
+
+        return etree, etree.parse(fn, etree.XMLParser(target=TreeBuilder()))
+    return etree, etree.parse(fn, etree.XMLParser(remove_blank_text=True))
+
+def _indent(element, level=0):
+    # ElementTree.indent, which needs Python 3.9
+    if len(element):
+        if not element.text or not element.text.strip():
+            element.text = "\n" + "  " * (level + 1)
+        for child in element:
+            _indent(child, level + 1)
+            if not child.tail or not child.tail.strip():
+                child.tail = "\n" + "  " * (level + 1)
+        child.tail = "\n" + "  " * level
+
+def _escape(s, attribute=False):
+    s = s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\r", "&#13;")
+    if attribute:
+        s = s.replace('"', "&quot;").replace("\n", "&#10;").replace("\t", "&#9;")
+    return s
+
+def _serialize(element, out):
+    # what lxml writes. ElementTree sorts attributes before Python 3.8
+    if callable(element.tag):
+        out.append("<!--%s-->" % element.text)
+    else:
+        out.append("<" + element.tag)
+        for name, value in element.attrib.items():
+            out.append(' %s="%s"' % (name, _escape(value, True)))
+        if element.text or len(element):
+            out.append(">" + _escape(element.text or ""))
+            for child in element:
+                _serialize(child, out)
+            out.append("</%s>" % element.tag)
+        else:
+            out.append("/>")
+    out.append(_escape(element.tail or ""))
+
+def _write_service(etree, tree, fn):
+    if etree.__name__ == "lxml.etree":
+        tree.write(fn, pretty_print=True)
+        return
+    root = tree.getroot()
+    _indent(root)
+    out = []
+    _serialize(root, out)
+    with open(fn, "wb") as fh:
+        fh.write(("".join(out) + "\n").encode("ascii", "xmlcharrefreplace"))
+
+def _service_params(node):
+    return {p.get("name"): p.text for p in node if p.tag == "param"}
+
+def _generated_service(node, params):
+    # exactly what update_obs_service writes, anything else belongs to the user
+    if len(node.attrib) != 1 or len(params) != len(node):
+        return False
+    if node.get("name") == "download_url":
+        return params.keys() == {"url", "prefer-old"} and params["prefer-old"] == "enable"
+    return (params.keys() == {"scm", "url", "revision", "version"} and params["scm"] == "git"
+            and params["revision"] == params["version"])
+
+def update_obs_service(args, table):
+    ET, tree = _read_service(args.obs_service)
+    root = tree.getroot()
+
+    # services we want, keyed by (name, url, revision)
+    wanted = dict()
+    urls = {"download_url": set(), "obs_scm": set()}
+    for fn in sorted(table):
+        dep = table[fn]
+        if dep.scm:
+            key = ("obs_scm", dep.url, dep.branch)
+        elif not args.obs_service_scm_only:
+            key = ("download_url", dep.url, None)
+        else:
+            continue
+        urls[key[0]].add(dep.url)
+        if not args.file or fn in args.file:
+            wanted[key] = dep
+
+    # a service is ours if it is for a url we write, or a download_url that
+    # looks like one we write. An obs_scm needs the url to match, the package
+    # itself often comes from one. Ours are kept if still wanted and removed
+    # otherwise
+    changed = False
+    present = set()
+    for node in list(root):
+        name = node.get("name") if node.tag == "service" else None
+        if name not in urls or name == "download_url" and args.obs_service_scm_only:
+            continue
+        params = _service_params(node)
+        generated = _generated_service(node, params)
+        if params.get("url") not in urls[name] and not (generated and name == "download_url"):
+            continue
+        key = (name, params.get("url"), params.get("revision") if name == "obs_scm" else None)
+        if generated and key in wanted and key not in present:
+            present.add(key)
+            continue
+        root.remove(node)
+        changed = True
+
+    for key, dep in wanted.items():
+        if key in present:
+            continue
+        changed = True
+        if dep.scm:
+            s = ET.SubElement(root, 'service', {'name': 'obs_scm'})
+            ET.SubElement(s, 'param', {'name': 'scm'}).text = "git"
+            ET.SubElement(s, 'param', {'name': 'url'}).text = dep.url
+            ET.SubElement(s, 'param', {'name': 'revision'}).text = dep.branch
+            ET.SubElement(s, 'param', {'name': 'version'}).text = dep.branch
+        else:
+            s = ET.SubElement(root, 'service', {'name': 'download_url'})
+            ET.SubElement(s, 'param', {'name': 'url'}).text = dep.url
+            ET.SubElement(s, 'param', {'name': 'prefer-old'}).text = 'enable'
+
+    if not changed:
+        logging.info("%s is up to date", args.obs_service)
+        return False
+    # to make sure pretty printing works
+    for element in root.iter():
+        element.tail = None
+    _write_service(ET, tree, args.obs_service)
+    return True
+
+def main(args, table=None, mirrors=None):
+    metrics = Metrics()
+    start = time.perf_counter()
+
     # special settings when run as obs service
     if args.outdir:
         if not args.spec and not args.output:
@@ -379,174 +2120,185 @@ def main(args):
     def _out(fn):
         return os.path.join(args.outdir, fn) if args.outdir else fn
 
-    pattern = f"*{args.input}"
-    input_file = next(reversed(sorted(Path(Path.cwd()).glob(pattern))), None)
+    # members of the previous archive are carried over instead of being
+    # extracted and fetched again
+    old_cpio = None
+    if (args.download and args.cpio and os.path.exists(args.cpio)
+            and (args.verify_local or not args.download_always)):
+        old_cpio = CpioReader(args.cpio)
+
+    # downloads start as soon as dependencies get resolved. With a previous
+    # archive the table is resolved first, if the archive has exactly what it
+    # needs nothing gets fetched or written
+    unchanged = False
+    deferred = old_cpio is not None and not args.verify_local
+    resolved = table is not None
+    if not resolved:
+        table = DependencyTable(args.compression)
+    pipeline = None
+    try:
+        if args.download and not deferred:
+            pipeline = DownloadPipeline(args, table, _out, old_cpio, mirrors, metrics)
+
+        if not resolved:
+            load_dependencies(table, args, pipeline.schedule if pipeline else None, metrics)
+
+        if deferred:
+            unchanged = _archive_unchanged(table, old_cpio, args.cpio_compression == "gzip", _out)
+            if unchanged:
+                logging.info("%s is up to date", args.cpio)
+                for fn in table:
+                    if not args.file or fn in args.file:
+                        metrics.count("skipped")
+                        if not table[fn].scm:
+                            table[fn].size = old_cpio.lookup(fn).size
+            else:
+                pipeline = DownloadPipeline(args, table, _out, old_cpio, mirrors, metrics)
 
-    with open(input_file) as fh:
-        js = json.load(fh)
+        if pipeline:
+            for fn in sorted(table):
+                pipeline.schedule(fn)
 
-    if "name" in js:
-        process_packagelock_file(js)
-    else:
-        for i in js.keys():
-            process_packagelock_file(js[i])
-
-    if args.output:
-        with open(_out(args.output), "w") as fh:
-            write_rpm_sources(fh, args)
-
-    if args.spec:
-        ok = False
-        newfn = _out(args.spec)
-        if not args.outdir:
-            newfn += '.new'
-        with open(newfn, "w") as ofh:
+        if args.output:
+            fh = io.StringIO()
+            write_rpm_sources(fh, table, args)
+            _write_if_changed(_out(args.output), fh.getvalue(), args.output)
+
+        if args.spec:
+            ok = False
+            ofh = io.StringIO()
             with open(args.spec, "r") as ifh:
                 for line in ifh:
                     if line.startswith('# NODE_MODULES BEGIN'):
                         ofh.write(line)
                         for line in ifh:
                             if line.startswith('# NODE_MODULES END'):
-                                write_rpm_sources(ofh, args)
+                                write_rpm_sources(ofh, table, args)
                                 ok = True
                                 break
 
                     ofh.write(line)
-        if not ok:
-            raise Exception("# NODE_MODULES [BEGIN|END] not found")
-        if not args.outdir:
-            os.rename(args.spec+".new", args.spec)
+            if not ok:
+                raise Exception("# NODE_MODULES [BEGIN|END] not found")
+            _write_if_changed(_out(args.spec), ofh.getvalue(), args.spec)
+
+        if args.cpio and not unchanged:
+            # members are written in sorted order as soon as they are available
+            with CpioWriter(_out(args.cpio) + ".new", args.cpio_compression == "gzip") as c:
+                for fn in sorted(table):
+                    if pipeline and pipeline.wait(fn) is False:
+                        _unlink_quiet(_out(args.cpio) + ".new")
+                        raise Exception("failed to fetch %s" % fn)
+                    with metrics.timer("cpio_write"):
+                        if pipeline and pipeline.archived(fn) and not os.path.exists(_out(fn)):
+                            c.addfrom(old_cpio, os.path.basename(fn))
+                            continue
+                        with open(_out(fn), 'rb') as fh:
+                            c.addstream(os.path.basename(fn), fh)
+                        os.unlink(_out(fn))
+            _replace_if_changed(_out(args.cpio) + ".new", _out(args.cpio), args.cpio)
+    finally:
+        # also on errors, so the event loop and its connections are closed
+        if pipeline:
+            pipeline.finish()
+        if old_cpio:
+            old_cpio.close()
+
+    # written last so it has the sizes of tarballs fetched by this run
+    if args.manifest_out:
+        fh = io.StringIO()
+        write_manifest(fh, table, _is_ndjson(args.manifest_out))
+        _write_if_changed(_out(args.manifest_out), fh.getvalue(), args.manifest_out)
 
-    if args.download:
-        if args.cpio and os.path.exists(args.cpio) and not args.download_always:
-            CpioReader(args.cpio).extract(args.outdir)
+    if args.obs_service:
+        with metrics.timer("service_rewrite"):
+            update_obs_service(args, table)
+
+    metrics.add_time("total", time.perf_counter() - start)
+    metrics.count("dependencies", len(table))
+    if args.metrics:
+        metrics.write(_out(args.metrics))
+    for line in metrics.summary():
+        logging.info("%s", line)
+
+    if metrics.counters["failed"]:
+        logging.error("%d dependencies could not be fetched", metrics.counters["failed"])
+        return 1
+    return 0
 
-        for fn in sorted(MODULE_MAP):
-            if args.file and fn not in args.file:
-                continue
-            url = MODULE_MAP[fn]["url"]
-            if "scm" in MODULE_MAP[fn]:
-                if os.path.exists(_out(fn)) and MODULE_MAP[fn]["branch"] != "master" and not args.download_always:
-                    logging.info("skipping update of existing %s", _out(fn))
+def batch_main(args):
+    # resolve all packages first, fetch every tarball only once into a
+    # shared cache and then let each package pick from there
+    topdir = os.getcwd()
+    tmpcache = None
+    if not args.cache:
+        tmpcache = tempfile.mkdtemp(prefix=".node_modules-cache-", dir=topdir)
+        args.cache = tmpcache
+    args.cache = os.path.abspath(args.cache)
+    args.git_cache = os.path.abspath(args.git_cache if args.git_cache else topdir)
+    args.download = True
+    mirrors = GitMirrorCache(args.git_cache)
+
+    packages = []
+    # (algo, checksum) -> (fn, dependency) of tarballs some package lacks
+    wanted = dict()
+    try:
+        for d in args.batch:
+            os.chdir(os.path.join(topdir, d))
+            pargs = argparse.Namespace(**vars(args))
+            # evicted once at the end, packages processed later still need
+            # what was staged for them
+            pargs.cache_size = None
+            if not pargs.spec and not pargs.output:
+                specfiles = glob.glob('*.spec')
+                if len(specfiles) != 1:
+                    raise Exception("%s: need exactly one spec file" % d)
+                pargs.spec = specfiles[0]
+            table = DependencyTable(pargs.compression)
+            load_dependencies(table, pargs)
+            packages.append((d, pargs, table))
+
+            archive = None
+            if pargs.cpio and os.path.exists(pargs.cpio) and not pargs.download_always:
+                archive = CpioReader(pargs.cpio)
+            for fn in table:
+                dep = table[fn]
+                if dep.scm or (args.file and fn not in args.file):
                     continue
-
-                d = MODULE_MAP[fn]["basename"]
-                # TODO: use same cache as tar_scm
-                if os.path.exists(d):
-                    r = subprocess.run(["git", "remote", "update"], cwd=d)
-                    if r.returncode:
-                        logging.error("failed to clone %s", url)
-                        continue
-                else:
-                    r = subprocess.run(["git", "clone", "--bare", url, d])
-                    if r.returncode:
-                        logging.error("failed to clone %s", url)
-                        continue
-                r = subprocess.run(
-                    [
-                        "git",
-                        "archive",
-                        "--format=tar." + (OBS_SCM_COMPRESSION if OBS_SCM_COMPRESSION else 'gz'),
-                        "-o",
-                        _out(fn),
-                        "--prefix",
-                        "package/",
-                        MODULE_MAP[fn]["branch"],
-                    ],
-                    cwd=d,
-                )
-                if not args.outdir:
-                    os.rename(os.path.join(d, fn), fn)
-                if r.returncode:
-                    logging.error("failed to create tar %s", url)
+                if archive is not None and archive.lookup(fn) is not None:
                     continue
-            else:
-                req = urllib.request.Request(url)
-                if os.path.exists(_out(fn)):
-                    if not args.download_always:
-                        logging.info("skipping download of existing %s", fn)
-                        continue
-                    stamp = time.strftime(
-                        "%a, %d %b %Y %H:%M:%S GMT", time.gmtime(os.path.getmtime(_out(fn)))
-                    )
-                    logging.debug("adding If-Modified-Since %s: %s", fn, stamp)
-                    req.add_header("If-Modified-Since", stamp)
-
-                logging.info("fetching %s as %s", url, fn)
-                algo = MODULE_MAP[fn]["algo"]
-                chksum = MODULE_MAP[fn]["chksum"]
-                h = hashlib.new(algo)
-                response = urllib.request.urlopen(req)
-                try:
-                    data = response.read()
-                    h.update(data)
-                    if h.hexdigest() != chksum:
-                        logging.error(
-                            "checksum failure for %s %s %s %s",
-                            fn,
-                            algo,
-                            h.hexdigest,
-                            chksum,
-                        )
-                    else:
-                        try:
-                            with open(_out(fn) + ".new", "wb") as fh:
-                                fh.write(data)
-                        except OSError as e:
-                            logging.error(e)
-                        finally:
-                            os.rename(_out(fn) + ".new", _out(fn))
-                except urllib.error.HTTPError as e:
-                    logging.error(e)
-
-    if args.cpio:
-        with CpioWriter(_out(args.cpio) + ".new") as c:
-            for fn in sorted(MODULE_MAP):
-                with open(_out(fn), 'rb') as fh:
-                    c.addstream(os.path.basename(fn), fh)
-                os.unlink(_out(fn))
-        os.rename(_out(args.cpio) + ".new", _out(args.cpio))
-
-    if args.obs_service:
-        parser = ET.XMLParser(remove_blank_text=True)
-        tree = ET.parse(args.obs_service, parser)
-        root = tree.getroot()
-        # to make sure pretty printing works
-        for element in root.iter():
-            element.tail = None
-
-        if not args.obs_service_scm_only:
-            # FIXME: remove only entries we added?
-            for node in root.findall("service[@name='download_url']"):
-                root.remove(node)
-
-        tar_scm_toremove = set()
-        for fn in sorted(MODULE_MAP):
-            if "scm" in MODULE_MAP[fn]:
-                tar_scm_toremove.add(MODULE_MAP[fn]['url'])
-
-        for u in tar_scm_toremove:
-            for node in root.findall("service[@name='obs_scm']"):
-                if node.find("param[@name='url']").text == u:
-                    root.remove(node)
-
-        for fn in sorted(MODULE_MAP):
-            if args.file and fn not in args.file:
-                continue
-            url = MODULE_MAP[fn]["url"]
-            if "scm" in MODULE_MAP[fn]:
-                s = ET.SubElement(root, 'service', {'name': 'obs_scm'})
-                ET.SubElement(s, 'param', {'name': 'scm'}).text = "git"
-                ET.SubElement(s, 'param', {'name': 'url'}).text = MODULE_MAP[fn]["url"]
-                ET.SubElement(s, 'param', {'name': 'revision'}).text = MODULE_MAP[fn]["branch"]
-                ET.SubElement(s, 'param', {'name': 'version'}).text = MODULE_MAP[fn]["branch"]
-            elif not args.obs_service_scm_only:
-                s = ET.SubElement(root, 'service', {'name': 'download_url'})
-                ET.SubElement(s, 'param', {'name': 'url'}).text = MODULE_MAP[fn]["url"]
-                ET.SubElement(s, 'param', {'name': 'prefer-old'}).text = 'enable'
-
-        tree.write(args.obs_service, pretty_print=True)
-
+                if os.path.exists(fn) and not pargs.download_always:
+                    continue
+                wanted.setdefault((dep.algo, dep.chksum), (fn, dep))
+            if archive is not None:
+                archive.close()
+
+        logging.info("fetching %d unique tarballs for %d packages", len(wanted), len(packages))
+        staging = tempfile.mkdtemp(prefix=".node_modules-staging-", dir=topdir)
+        try:
+            staged = DependencyTable()
+            for fn, dep in wanted.values():
+                staged.deps[fn] = dep
+            _run_async(fetch(staged, staging, TarballCache(args.cache), **fetch_options(args)))
+        finally:
+            shutil.rmtree(staging)
+
+        failed = []
+        for d, pargs, table in packages:
+            logging.info("processing %s", d)
+            os.chdir(os.path.join(topdir, d))
+            if main(pargs, table, mirrors):
+                failed.append(d)
+        if args.cache_size and not tmpcache:
+            TarballCache(args.cache, parse_size(args.cache_size)).evict()
+    finally:
+        os.chdir(topdir)
+        if tmpcache:
+            shutil.rmtree(tmpcache)
+
+    if failed:
+        logging.error("incomplete: %s", ", ".join(failed))
+        return 1
     return 0
 
 
@@ -564,6 +2316,19 @@ if __name__ == "__main__":
         default="package-lock.json",
         help="input package lock file",
     )
+    parser.add_argument(
+        "--manifest", metavar="FILE",
+        help="read resolved dependencies from a manifest instead of the lock file",
+    )
+    parser.add_argument(
+        "--manifest-out", metavar="FILE",
+        help="write resolved dependencies as JSON manifest (NDJSON if FILE ends in .ndjson)",
+    )
+    parser.add_argument(
+        "--stream-lockfile",
+        action="store_true",
+        help="resolve packages while reading the lock file instead of loading it first",
+    )
     parser.add_argument(
         "-f", "--file", nargs="+", metavar="FILE", help="limit to file"
     )
@@ -576,6 +2341,10 @@ if __name__ == "__main__":
     parser.add_argument(
         "--source-offset", metavar="N", type=int, help="Spec file source offset"
     )
+    parser.add_argument(
+        "--batch", nargs="+", metavar="DIR",
+        help="process the packages in these directories, sharing downloads between them",
+    )
     parser.add_argument(
         "--obs-service", metavar="FILE", help="OBS service file for download_url"
     )
@@ -585,6 +2354,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--cpio", metavar="ARCHIVE", help="cpio archive to use instead of individual files"
     )
+    parser.add_argument(
+        "--cpio-compression",
+        choices=("none", "gzip"),
+        default="none",
+        help="write the cpio archive as independently compressed gzip frames with an index",
+    )
     parser.add_argument(
         "--compression", metavar="EXT", help="use EXT compression"
     )
@@ -595,6 +2370,62 @@ if __name__ == "__main__":
     )
 
     parser.add_argument("--download", action="store_true", help="download files")
+    parser.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=8,
+        help="number of parallel downloads",
+    )
+    parser.add_argument(
+        "--metrics", metavar="FILE",
+        help="write timings and counters of the run to FILE, in Prometheus textfile format if it ends in .prom, JSON otherwise",
+    )
+    parser.add_argument(
+        "--timeout", metavar="SECONDS", type=float, default=60,
+        help="connect and read timeout of each request",
+    )
+    parser.add_argument(
+        "--retries", metavar="N", type=int, default=3,
+        help="retries of a download after transient errors",
+    )
+    parser.add_argument(
+        "--registry", metavar="URL", default=DEFAULT_REGISTRY,
+        help="registry the lock file refers to, see --mirror",
+    )
+    parser.add_argument(
+        "--mirror", metavar="URL", action="append",
+        help="fetch registry tarballs from this mirror first, can be given multiple times",
+    )
+    parser.add_argument(
+        "--max-per-host", metavar="N", type=int,
+        help="at most N parallel downloads from the same host",
+    )
+    parser.add_argument(
+        "--max-rate", metavar="RATE",
+        help="limit all downloads together to RATE bytes per second (eg. 10M)",
+    )
+    parser.add_argument(
+        "--git-jobs", metavar="N", type=int,
+        help="parallel git fetches, defaults to --jobs",
+    )
+    parser.add_argument(
+        "--resolve-cache", metavar="DIR",
+        help="cache resolved lock files by their content hash",
+    )
+    parser.add_argument(
+        "--git-cache", metavar="DIR",
+        help="where to keep mirrors of git dependencies (default: current directory)",
+    )
+    parser.add_argument(
+        "--verify-local",
+        action="store_true",
+        help="check existing files against the lockfile checksums and only download the broken ones",
+    )
+    parser.add_argument(
+        "--cache", metavar="DIR", help="tarball cache shared between runs"
+    )
+    parser.add_argument(
+        "--cache-size", metavar="SIZE",
+        help="evict least recently used tarballs beyond SIZE (eg. 10G)",
+    )
     parser.add_argument(
         "--download-always",
         action="store_true",
@@ -615,11 +2446,13 @@ if __name__ == "__main__":
     if args.outdir and not args.outdir[0] == '/':
         raise Exception("outdir must be absolute")
 
-    if args.compression:
-        OBS_SCM_COMPRESSION = args.compression
-    elif args.obs_service:
-        OBS_SCM_COMPRESSION = 'xz'
+    if args.outdir and args.batch:
+        raise Exception("outdir can't be used in batch mode")
+
+    # this is a hack for obs_scm integration
+    if not args.compression and args.obs_service:
+        args.compression = 'xz'
 
-    sys.exit(main(args))
+    sys.exit(batch_main(args) if args.batch else main(args))
 
 # vim: sw=4 et
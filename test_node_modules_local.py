@@ -0,0 +1,901 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import types
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent))
+import node_modules  # noqa: E402
+
+
+SCRIPT = Path(__file__).parent / "node_modules.py"
+
+
+class RegistryHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path in self.server.stalled:
+            # never answers, until the test is over
+            self.server.released.wait(30)
+            return
+        if self.server.failures.get(self.path, 0) > 0:
+            self.server.failures[self.path] -= 1
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        content = self.server.tarballs.get(self.path.lstrip("/"))
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        if self.server.encode and "gzip" in self.headers.get("Accept-Encoding", ""):
+            # like a CDN that compresses whatever the client accepts
+            content = gzip.compress(content)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_registry():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RegistryHandler)
+    server.tarballs = {}
+    server.requests = []
+    server.failures = {}
+    server.stalled = set()
+    server.encode = False
+    server.released = threading.Event()
+    server.connections = 0
+    server.url = "http://127.0.0.1:%d" % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def registry():
+    """local stand-in for registry.npmjs.org serving in-memory tarballs"""
+    server = start_registry()
+    yield server
+    server.released.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def mirror():
+    server = start_registry()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def integrity(content):
+    return "sha512-" + base64.b64encode(hashlib.sha512(content).digest()).decode()
+
+
+def write_lockfile(path, registry, count=20, corrupt=()):
+    packages = {"": {"name": "test", "version": "1.0.0"}}
+    for i in range(count):
+        name = "pkg%d" % i
+        fn = "%s-1.0.%d.tgz" % (name, i)
+        content = ("content of %s\n" % fn).encode() * (i + 1)
+        registry.tarballs["%s/-/%s" % (name, fn)] = content
+        packages["node_modules/" + name] = {
+            "version": "1.0.%d" % i,
+            "resolved": "%s/%s/-/%s" % (registry.url, name, fn),
+            "integrity": integrity(b"corrupt" if name in corrupt else content),
+        }
+    lockfile = {"name": "test", "lockfileVersion": 3, "packages": packages}
+    (path / "package-lock.json").write_text(json.dumps(lockfile))
+
+
+def run(path, *args):
+    return subprocess.run(
+        [sys.executable, str(SCRIPT)] + list(args),
+        cwd=str(path),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+
+def test_parallel_download(tmp_path, registry):
+    write_lockfile(tmp_path, registry)
+    r = run(tmp_path, "--download", "--jobs", "4")
+    assert r.returncode == 0, r.stderr
+
+    for name, content in registry.tarballs.items():
+        fn = os.path.basename(name)
+        assert (tmp_path / fn).read_bytes() == content
+    assert len(registry.requests) == len(registry.tarballs)
+    assert not list(tmp_path.glob("*.new"))
+
+    # existing files are not fetched again
+    r = run(tmp_path, "--download", "--jobs", "4")
+    assert r.returncode == 0, r.stderr
+    assert len(registry.requests) == len(registry.tarballs)
+
+
+def test_checksum_failure(tmp_path, registry):
+    write_lockfile(tmp_path, registry, count=4, corrupt=("pkg2",))
+    r = run(tmp_path, "--download", "--jobs", "2")
+    assert r.returncode == 1, r.stderr
+    assert "checksum failure for pkg2-1.0.2.tgz" in r.stderr
+
+    assert not (tmp_path / "pkg2-1.0.2.tgz").exists()
+    assert not (tmp_path / "pkg2-1.0.2.tgz.new").exists()
+    assert (tmp_path / "pkg3-1.0.3.tgz").exists()
+
+
+def test_retry(tmp_path, registry):
+    write_lockfile(tmp_path, registry, count=4)
+    registry.failures["/pkg1/-/pkg1-1.0.1.tgz"] = 2
+    registry.failures["/pkg3/-/pkg3-1.0.3.tgz"] = 5
+    r = run(tmp_path, "--download", "--retries", "3")
+    # the other tarballs are there, but the run failed
+    assert r.returncode == 1, r.stderr
+
+    assert (tmp_path / "pkg1-1.0.1.tgz").exists()
+    assert registry.requests.count("/pkg1/-/pkg1-1.0.1.tgz") == 3
+    # gave up after the initial try and three retries
+    assert not (tmp_path / "pkg3-1.0.3.tgz").exists()
+    assert registry.requests.count("/pkg3/-/pkg3-1.0.3.tgz") == 4
+    assert "failed to fetch pkg3-1.0.3.tgz" in r.stderr
+
+
+def test_retry_after_limit():
+    fetcher = node_modules.TarballFetcher(1)
+    stamp = "Fri, 01 Jan 2100 00:00:00 GMT"
+    for value in ("86400", stamp):
+        retry_after = node_modules._parse_retry_after(value)
+        assert retry_after > node_modules.BACKOFF_MAX
+        assert fetcher._delay("pkg.tgz", 0, retry_after) == node_modules.BACKOFF_MAX
+
+
+@pytest.mark.parametrize("transport", ["aiohttp", "urllib3"])
+def test_timeout(tmp_path, registry, transport):
+    if transport == "aiohttp":
+        pytest.importorskip("aiohttp")
+    write_lockfile(tmp_path, registry, count=4)
+    registry.stalled.add("/pkg2/-/pkg2-1.0.2.tgz")
+    table = node_modules.DependencyTable()
+    node_modules.read_packagelock(table, str(tmp_path / "package-lock.json"))
+    start = time.monotonic()
+    results = node_modules._run_async(node_modules.fetch(
+        table, str(tmp_path), timeout=0.5, retries=1, transport=transport))
+    assert time.monotonic() - start < 10
+    assert results.pop("pkg2-1.0.2.tgz") is False
+    assert all(results.values())
+    assert registry.requests.count("/pkg2/-/pkg2-1.0.2.tgz") == 2
+    assert not (tmp_path / "pkg2-1.0.2.tgz").exists()
+
+
+@pytest.mark.parametrize("transport", ["aiohttp", "urllib3"])
+def test_content_encoding(tmp_path, registry, transport):
+    if transport == "aiohttp":
+        pytest.importorskip("aiohttp")
+    write_lockfile(tmp_path, registry, count=3)
+    registry.encode = True
+    table = node_modules.DependencyTable()
+    node_modules.read_packagelock(table, str(tmp_path / "package-lock.json"))
+    results = node_modules._run_async(node_modules.fetch(table, str(tmp_path), transport=transport))
+    assert all(results.values())
+    for fn in results:
+        name = fn.rsplit("-", 1)[0]
+        assert (tmp_path / fn).read_bytes() == registry.tarballs["%s/-/%s" % (name, fn)]
+
+
+@pytest.mark.parametrize("cpio", [False, True])
+def test_missing_tarball(tmp_path, registry, cpio):
+    write_lockfile(tmp_path, registry, count=4)
+    del registry.tarballs["pkg1/-/pkg1-1.0.1.tgz"]
+    args = ("--cpio", "node_modules.obscpio") if cpio else ()
+    r = run(tmp_path, "--download", *args)
+    assert r.returncode == 1, r.stderr
+    assert "failed to fetch pkg1-1.0.1.tgz" in r.stderr
+    assert "Unclosed" not in r.stderr
+    assert not (tmp_path / "node_modules.obscpio").exists()
+    assert not (tmp_path / "node_modules.obscpio.new").exists()
+    if cpio:
+        assert "Exception: failed to fetch pkg1-1.0.1.tgz" in r.stderr
+    else:
+        assert len(list(tmp_path.glob("*.tgz"))) == 3
+
+
+def test_mirror_failover(tmp_path, registry, mirror):
+    write_lockfile(tmp_path, registry, count=4)
+    # the mirror lacks pkg2 and the dead one is not listening at all
+    for name, content in registry.tarballs.items():
+        if not name.startswith("pkg2/"):
+            mirror.tarballs[name] = content
+    dead = start_registry()
+    dead.shutdown()
+    dead.server_close()
+    r = run(
+        tmp_path, "--download", "--retries", "0", "--registry", registry.url,
+        "--mirror", dead.url, "--mirror", mirror.url,
+    )
+    assert r.returncode == 0, r.stderr
+
+    for name, content in registry.tarballs.items():
+        assert (tmp_path / os.path.basename(name)).read_bytes() == content
+    assert registry.requests == ["/pkg2/-/pkg2-1.0.2.tgz"]
+    assert len(mirror.requests) == 4
+
+
+def test_metrics(tmp_path, registry):
+    write_lockfile(tmp_path, registry, count=6)
+    r = run(tmp_path, "--download", "--cpio", "node_modules.obscpio", "--metrics", "metrics.json", "--verbose")
+    assert r.returncode == 0, r.stderr
+    metrics = json.loads((tmp_path / "metrics.json").read_text())
+    for phase in ("parse", "resolve", "hash", "cpio_write", "total"):
+        assert phase in metrics["seconds"]
+    assert metrics["counters"]["fetched"] == 6
+    assert metrics["counters"]["download_bytes"] == sum(len(c) for c in registry.tarballs.values())
+    assert metrics["counters"]["hash_bytes"] == metrics["counters"]["download_bytes"]
+    assert sorted(d["filename"] for d in metrics["downloads"]) == sorted(
+        os.path.basename(name) for name in registry.tarballs)
+    assert "downloads        6," in r.stderr
+    assert "MB/s per core" in r.stderr
+    # there is no cache to report on
+    assert "cache hits" not in r.stderr
+
+    # a second run keeps everything from the archive
+    r = run(tmp_path, "--download", "--cpio", "node_modules.obscpio", "--metrics", "metrics.prom")
+    assert r.returncode == 0, r.stderr
+    prom = (tmp_path / "metrics.prom").read_text()
+    assert 'node_modules_events_total{event="skipped"} 6\n' in prom
+    assert 'node_modules_download_seconds_bucket{le="+Inf"} 0\n' in prom
+    assert 'node_modules_phase_seconds{phase="cpio_write"}' not in prom
+
+
+def test_scheduler_order_and_host_limit():
+    async def order_and_limit():
+        scheduler = node_modules.FetchScheduler(1)
+        release = asyncio.Event()
+        order = []
+
+        async def blocker():
+            await release.wait()
+
+        async def job(size):
+            order.append(size)
+
+        first = asyncio.ensure_future(scheduler.run("a", None, blocker))
+        await asyncio.sleep(0)
+        jobs = [asyncio.ensure_future(scheduler.run("a", size, job, size)) for size in (1, 5, None, 3)]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *jobs)
+        # largest first, unknown sizes last
+        assert order == [5, 3, 1, None]
+
+        scheduler = node_modules.FetchScheduler(6, per_host=2)
+        active = {"a": 0, "b": 0}
+        peak = {"a": 0, "b": 0}
+
+        async def limited(host):
+            active[host] += 1
+            peak[host] = max(peak[host], active[host])
+            await asyncio.sleep(0.01)
+            active[host] -= 1
+
+        await asyncio.gather(*[scheduler.run(host, None, limited, host) for host in "ab" * 8])
+        assert peak == {"a": 2, "b": 2}
+
+    node_modules._run_async(order_and_limit())
+
+
+def test_token_bucket():
+    bucket = node_modules.TokenBucket(4 << 20, burst=1 << 20)
+    start = time.monotonic()
+    for _ in range(16):
+        bucket.consume(64 << 10)
+    # the burst goes through at once, the rest at 4 MiB/s
+    assert time.monotonic() - start < 0.1
+    for _ in range(32):
+        bucket.consume(64 << 10)
+    assert time.monotonic() - start >= 0.45
+
+
+def test_max_per_host(tmp_path, registry):
+    write_lockfile(tmp_path, registry)
+    r = run(tmp_path, "--download", "--jobs", "4", "--max-per-host", "1", "--max-rate", "1M")
+    assert r.returncode == 0, r.stderr
+    assert len(registry.requests) == 20
+    assert registry.connections == 1
+
+
+def test_connection_reuse(tmp_path, registry):
+    write_lockfile(tmp_path, registry)
+    r = run(tmp_path, "--download", "--jobs", "2", "--debug")
+    assert r.returncode == 0, r.stderr
+    assert len(registry.requests) == 20
+    assert registry.connections <= 2
+    assert "20 requests over %d connections" % registry.connections in r.stderr
+
+
+def test_tarball_cache(tmp_path, registry):
+    cache = tmp_path / "cache"
+    first = tmp_path / "first"
+    second = tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    write_lockfile(first, registry)
+    write_lockfile(second, registry)
+
+    r = run(first, "--download", "--cache", str(cache), "--verbose")
+    assert r.returncode == 0, r.stderr
+    assert len(registry.requests) == 20
+    assert "cache hits           0.0%" in r.stderr
+
+    r = run(second, "--download", "--cache", str(cache), "--verbose")
+    assert r.returncode == 0, r.stderr
+    assert len(registry.requests) == 20
+    assert "cache hits         100.0%" in r.stderr
+    for fn in first.glob("*.tgz"):
+        assert os.path.samefile(str(fn), str(second / fn.name))
+
+    r = run(second, "--download", "--cache", str(cache), "--cache-size", "1K")
+    assert r.returncode == 0, r.stderr
+    assert sum(f.stat().st_size for f in cache.rglob("*") if f.is_file()) <= 1024
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_incremental_cpio(tmp_path, registry, compression):
+    args = ("--download", "--cpio", "node_modules.obscpio", "--cpio-compression", compression)
+    incremental = tmp_path / "incremental"
+    full = tmp_path / "full"
+    incremental.mkdir()
+    full.mkdir()
+
+    write_lockfile(incremental, registry, count=10)
+    r = run(incremental, *args)
+    assert r.returncode == 0, r.stderr
+    assert len(registry.requests) == 10
+
+    # one more package, only that one gets fetched
+    write_lockfile(incremental, registry, count=11)
+    r = run(incremental, *args)
+    assert r.returncode == 0, r.stderr
+    assert registry.requests[10:] == ["/pkg10/-/pkg10-1.0.10.tgz"]
+    assert not list(incremental.glob("*.tgz"))
+
+    write_lockfile(full, registry, count=11)
+    r = run(full, *args)
+    assert r.returncode == 0, r.stderr
+    assert (incremental / "node_modules.obscpio").read_bytes() == (
+        full / "node_modules.obscpio"
+    ).read_bytes()
+
+
+def test_unchanged_outputs(tmp_path, registry):
+    args = ("--download", "--cpio", "node_modules.obscpio", "-o", "sources.inc",
+            "--manifest-out", "manifest.json", "--obs-service", "_service")
+    outputs = ("node_modules.obscpio", "sources.inc", "manifest.json", "_service")
+    (tmp_path / "_service").write_text(SERVICE)
+    write_lockfile(tmp_path, registry, count=5)
+    r = run(tmp_path, *args)
+    assert r.returncode == 0, r.stderr
+    for fn in outputs:
+        os.utime(str(tmp_path / fn), (0, 0))
+
+    # nothing changed, nothing is fetched or written
+    r = run(tmp_path, "--verbose", *args)
+    assert r.returncode == 0, r.stderr
+    assert len(registry.requests) == 5
+    assert "node_modules.obscpio is up to date" in r.stderr
+    for fn in outputs:
+        assert (tmp_path / fn).stat().st_mtime == 0, fn
+    assert not list(tmp_path.glob("*.new"))
+
+    write_lockfile(tmp_path, registry, count=6)
+    r = run(tmp_path, *args)
+    assert r.returncode == 0, r.stderr
+    assert registry.requests[5:] == ["/pkg5/-/pkg5-1.0.5.tgz"]
+    for fn in outputs:
+        assert (tmp_path / fn).stat().st_mtime != 0, fn
+
+
+def test_unchanged_outputs_outdir(tmp_path, registry):
+    # as osc service manualrun does it: a fresh outdir every time, whatever
+    # ends up there replaces the files of the package
+    (tmp_path / "test.spec").write_text("Name: test\n# NODE_MODULES BEGIN\n# NODE_MODULES END\n")
+    args = ("--cpio", "node_modules.obscpio", "-o", "node_modules.spec.inc")
+
+    def service(count):
+        write_lockfile(tmp_path, registry, count=count)
+        outdir = Path(tempfile.mkdtemp(prefix="out", dir=str(tmp_path)))
+        r = run(tmp_path, "--outdir", str(outdir), *args)
+        assert r.returncode == 0, r.stderr
+        produced = sorted(f.name for f in outdir.iterdir())
+        for f in outdir.iterdir():
+            f.rename(tmp_path / f.name)
+        return produced
+
+    assert service(5) == ["node_modules.obscpio", "node_modules.spec.inc"]
+    assert len(registry.requests) == 5
+    assert service(5) == []
+    assert len(registry.requests) == 5
+    assert service(6) == ["node_modules.obscpio", "node_modules.spec.inc"]
+    assert registry.requests[5:] == ["/pkg5/-/pkg5-1.0.5.tgz"]
+    with node_modules.CpioReader(str(tmp_path / "node_modules.obscpio")) as reader:
+        assert len(reader.names()) == 6
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_cpio_index(tmp_path, compress):
+    members = {
+        "a.tgz": b"a",
+        "bb.tgz": b"bb" * 1000,
+        "empty.tgz": b"",
+        "gz.tgz": gzip.compress(b"gz" * 100),
+        "z.tgz": b"z" * 300,
+    }
+    for name, content in members.items():
+        (tmp_path / name).write_bytes(content)
+    archive = str(tmp_path / "test.obscpio")
+    # small frames, so bb.tgz has one of its own and the rest are shared
+    with node_modules.CpioWriter(archive, compress, frame_size=1024) as c:
+        for name in sorted(members):
+            with open(str(tmp_path / name), "rb") as fh:
+                c.addstream(name, fh)
+
+    with node_modules.CpioReader(archive) as reader:
+        assert reader.names() == sorted(members)
+        assert reader.lookup("missing.tgz") is None
+        assert reader.lookup("bb.tgz").size == 2000
+        for name, content in members.items():
+            assert b"".join(reader.stream(name, 7)) == content
+            assert reader.digest(name, "sha512") == hashlib.sha512(content).hexdigest()
+
+        out = tmp_path / "out"
+        out.mkdir()
+        reader.extract(str(out), ["bb.tgz"])
+        assert [f.name for f in out.iterdir()] == ["bb.tgz"]
+        assert (out / "bb.tgz").read_bytes() == members["bb.tgz"]
+
+        assert reader.compressed == compress
+        if compress:
+            assert len({reader.lookup(name).frame for name in members}) == 3
+
+    if compress:
+        # the whole file still decompresses to a plain cpio archive
+        plain = tmp_path / "plain.obscpio"
+        plain.write_bytes(gzip.decompress((tmp_path / "test.obscpio").read_bytes()))
+        with node_modules.CpioReader(str(plain)) as reader:
+            for name, content in members.items():
+                assert b"".join(reader.stream(name)) == content
+
+
+@pytest.mark.parametrize("mmap_min", [0, 1 << 20])
+def test_hash_mapped(tmp_path, monkeypatch, mmap_min):
+    monkeypatch.setattr(node_modules, "MMAP_MIN", mmap_min)
+    content = os.urandom(3 * 65536 + 123)
+    fn = tmp_path / "data"
+    fn.write_bytes(content)
+    with open(str(fn), "rb") as fh:
+        for offset, size in ((0, None), (0, 0), (1, 10), (65535, 65538), (70000, len(content) - 70000)):
+            expected = content[offset:offset + size] if size is not None else content
+            assert node_modules._hash_mapped(fh, "sha256", offset, size) == hashlib.sha256(expected).hexdigest()
+
+
+def test_verify_local(tmp_path, registry):
+    write_lockfile(tmp_path, registry, count=10)
+    r = run(tmp_path, "--download")
+    assert r.returncode == 0, r.stderr
+    (tmp_path / "pkg3-1.0.3.tgz").write_bytes(b"broken")
+
+    r = run(tmp_path, "--download", "--download-always", "--verify-local", "--verbose")
+    assert r.returncode == 0, r.stderr
+    assert registry.requests[10:] == ["/pkg3/-/pkg3-1.0.3.tgz"]
+    assert "9 reused, 1 failed, 1 fetched" in r.stderr
+    assert (tmp_path / "pkg3-1.0.3.tgz").read_bytes() == registry.tarballs["pkg3/-/pkg3-1.0.3.tgz"]
+
+
+def make_git_repo(path, branches):
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+    work = path / "work"
+    work.mkdir()
+    subprocess.run(git + ["init", "-q"], cwd=str(work), check=True)
+    subprocess.run(git + ["symbolic-ref", "HEAD", "refs/heads/main"], cwd=str(work), check=True)
+    (work / "package.json").write_text('{"name": "dep"}')
+    subprocess.run(git + ["add", "package.json"], cwd=str(work), check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "init"], cwd=str(work), check=True)
+    for branch in branches:
+        subprocess.run(git + ["branch", branch], cwd=str(work), check=True)
+    bare = path / "dep.git"
+    subprocess.run(git + ["clone", "-q", "--bare", str(work), str(bare)], check=True)
+    return bare
+
+
+def test_git_mirror_cache(tmp_path):
+    bare = make_git_repo(tmp_path, ["v1"])
+    packages = {"": {"name": "test", "version": "1.0.0"}}
+    for name, branch in (("a", "main"), ("b", "v1"), ("c", "v1")):
+        packages["node_modules/" + name] = {
+            "version": "1.0.0",
+            "resolved": "git+file://%s#%s" % (bare, branch),
+        }
+    project = tmp_path / "project"
+    project.mkdir()
+    (project / "package-lock.json").write_text(
+        json.dumps({"name": "test", "lockfileVersion": 3, "packages": packages})
+    )
+    cache = tmp_path / "git-cache"
+
+    r = run(project, "--download", "--git-cache", str(cache), "--verbose")
+    assert r.returncode == 0, r.stderr
+    assert r.stderr.count("cloning file://") == 1
+    assert len(list(cache.glob("*.git"))) == 1
+    for fn in ("dep-main.tgz", "dep-v1.tgz"):
+        with tarfile.open(str(project / fn)) as tar:
+            assert tar.getnames() == ["package", "package/package.json"]
+
+    (project / "dep-v1.tgz").unlink()
+    r = run(project, "--download", "--git-cache", str(cache), "--verbose")
+    assert r.returncode == 0, r.stderr
+    assert "cloning" not in r.stderr
+    assert r.stderr.count("updating mirror of file://") == 1
+    assert (project / "dep-v1.tgz").exists()
+
+
+def test_git_mirror_cache_shared(tmp_path):
+    # separate caches on one directory stand in for concurrent runs
+    bare = make_git_repo(tmp_path, ["v1"])
+    cache = tmp_path / "git-cache"
+    caches = [node_modules.GitMirrorCache(str(cache)) for _ in range(4)]
+    results = []
+    threads = [threading.Thread(target=lambda c=c: results.append(c.mirror("file://%s" % bare))) for c in caches]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(results)) == 1 and None not in results
+    assert [p.name for p in cache.iterdir() if not p.name.endswith(".lock")] == [os.path.basename(results[0])]
+
+
+def test_json_stream():
+    import io
+
+    doc = {"a": 1, "b": [1, 2.5, {"c": None}], "d": {"e": "x" * 50, "f": {}}, "g": 12345}
+    stream = node_modules.JsonStream(io.StringIO(json.dumps(doc, indent=2)), chunk_size=7)
+    result = {}
+    for key in stream.members():
+        if key == "d":
+            result[key] = {k: stream.value() for k in stream.members()}
+        else:
+            result[key] = stream.value()
+    assert result == doc
+
+
+def test_stream_lockfile_same_result(tmp_path):
+    content = b"tarball"
+    packages = {"": {"name": "test", "version": "1.0.0"}}
+    for path, host in (
+        ("node_modules/a", "https://registry.npmjs.org"),
+        ("node_modules/a-b", "https://registry.npmjs.org"),
+        ("node_modules/a-b/node_modules/c", "https://registry.npmjs.org"),
+        # same tarball from another host, the first path in sorted order wins
+        ("node_modules/b/node_modules/c", "https://mirror.example.com"),
+        ("node_modules/@scope/c", "https://registry.npmjs.org"),
+    ):
+        name = path.split("node_modules/")[-1]
+        fn = name.split("/")[-1] + "-1.0.0.tgz"
+        packages[path] = {
+            "version": "1.0.0",
+            "resolved": "%s/%s/-/%s" % (host, name, fn),
+            "integrity": integrity(content),
+        }
+    # stored in reverse order, unlike what npm writes
+    packages = dict(reversed(list(packages.items())))
+    lockfile = {"name": "test", "lockfileVersion": 3, "packages": packages}
+    (tmp_path / "package-lock.json").write_text(json.dumps(lockfile))
+
+    r = run(tmp_path, "-o", "plain.inc")
+    assert r.returncode == 0, r.stderr
+    r = run(tmp_path, "-o", "streamed.inc", "--stream-lockfile")
+    assert r.returncode == 0, r.stderr
+    plain = (tmp_path / "plain.inc").read_text()
+    assert plain == (tmp_path / "streamed.inc").read_text()
+    assert "mirror.example.com" not in plain
+
+    shutil.copy(str(Path(__file__).parent / "data" / "package-lock.json"), str(tmp_path))
+    r = run(tmp_path, "-o", "plain.inc")
+    assert r.returncode == 0, r.stderr
+    r = run(tmp_path, "-o", "streamed.inc", "--stream-lockfile")
+    assert r.returncode == 0, r.stderr
+    assert (tmp_path / "plain.inc").read_text() == (tmp_path / "streamed.inc").read_text()
+
+
+def test_batch(tmp_path, registry):
+    for name, count in (("one", 12), ("two", 10)):
+        (tmp_path / name).mkdir()
+        write_lockfile(tmp_path / name, registry, count=count)
+        (tmp_path / name / (name + ".spec")).write_text(
+            "Name: %s\n# NODE_MODULES BEGIN\n# NODE_MODULES END\n" % name
+        )
+
+    r = run(tmp_path, "--batch", "one", "two", "--cpio", "node_modules.obscpio")
+    assert r.returncode == 0, r.stderr
+    # the tarballs of "two" are a subset of those of "one"
+    assert len(registry.requests) == 12
+    assert not [f for f in tmp_path.iterdir() if f.name.startswith(".node_modules")]
+
+    for name, count in (("one", 12), ("two", 10)):
+        assert (tmp_path / name / (name + ".spec")).read_text().count("Source") == count
+        with node_modules.CpioReader(str(tmp_path / name / "node_modules.obscpio")) as reader:
+            assert len(reader.names()) == count
+        assert not list((tmp_path / name).glob("*.tgz"))
+
+
+def test_batch_cache_size(tmp_path, registry):
+    for name, count in (("one", 5), ("two", 10)):
+        (tmp_path / name).mkdir()
+        write_lockfile(tmp_path / name, registry, count=count)
+        (tmp_path / name / (name + ".spec")).write_text(
+            "Name: %s\n# NODE_MODULES BEGIN\n# NODE_MODULES END\n" % name
+        )
+
+    cache = tmp_path / "cache"
+    r = run(tmp_path, "--batch", "one", "two", "--cpio", "node_modules.obscpio",
+            "--cache", str(cache), "--cache-size", "1")
+    assert r.returncode == 0, r.stderr
+    # nothing is evicted before the last package got its tarballs
+    assert len(registry.requests) == 10
+    with node_modules.CpioReader(str(tmp_path / "two" / "node_modules.obscpio")) as reader:
+        assert len(reader.names()) == 10
+    assert not [f for f in cache.rglob("*") if f.is_file()]
+
+
+@pytest.mark.parametrize("manifest", ["manifest.json", "manifest.ndjson"])
+def test_manifest(tmp_path, registry, manifest):
+    write_lockfile(tmp_path, registry, count=5)
+    r = run(tmp_path, "-o", "lockfile.inc", "--manifest-out", manifest)
+    assert r.returncode == 0, r.stderr
+
+    text = (tmp_path / manifest).read_text()
+    if manifest.endswith(".ndjson"):
+        records = [json.loads(line) for line in text.splitlines()]
+    else:
+        records = json.loads(text)["dependencies"]
+    assert [r["filename"] for r in records] == ["pkg%d-1.0.%d.tgz" % (i, i) for i in range(5)]
+    assert records[0]["paths"] == ["/node_modules/pkg0"]
+    assert records[0]["algo"] == "sha512"
+
+    (tmp_path / "package-lock.json").unlink()
+    r = run(tmp_path, "-o", "manifest.inc", "--manifest", manifest, "--download")
+    assert r.returncode == 0, r.stderr
+    assert (tmp_path / "lockfile.inc").read_text() == (tmp_path / "manifest.inc").read_text()
+    assert len(list(tmp_path.glob("*.tgz"))) == 5
+
+
+def test_resolve_cache(tmp_path, registry):
+    cache = tmp_path / "resolved"
+    project = tmp_path / "project"
+    project.mkdir()
+    write_lockfile(project, registry, count=5)
+
+    r = run(project, "-o", "first.inc", "--resolve-cache", str(cache), "--debug")
+    assert r.returncode == 0, r.stderr
+    assert "using cached resolution" not in r.stderr
+    assert len(list(cache.iterdir())) == 1
+
+    r = run(project, "-o", "second.inc", "--resolve-cache", str(cache), "--debug")
+    assert r.returncode == 0, r.stderr
+    assert "using cached resolution" in r.stderr
+    assert (project / "first.inc").read_text() == (project / "second.inc").read_text()
+
+    # other options or lockfile content resolve again
+    r = run(project, "-o", "third.inc", "--resolve-cache", str(cache), "--compression", "xz")
+    assert r.returncode == 0, r.stderr
+    write_lockfile(project, registry, count=6)
+    r = run(project, "-o", "fourth.inc", "--resolve-cache", str(cache), "--debug")
+    assert r.returncode == 0, r.stderr
+    assert "using cached resolution" not in r.stderr
+    assert (project / "fourth.inc").read_text().count("Source") == 6
+    assert len(list(cache.iterdir())) == 3
+
+
+@pytest.mark.parametrize("version", [2, 3])
+def test_benchmark(version):
+    r = subprocess.run(
+        [sys.executable, str(SCRIPT.parent / "benchmark.py"), "-n", "30", "--depth", "4",
+         "--lockfile-version", str(version), "--size", "1000", "--json", "-"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert r.returncode == 0
+    results = json.loads(r.stdout)["results"]
+    assert [p["phase"] for p in results] == ["startup", "parse", "download", "cpio-write", "cpio-extract", "service"]
+    for p in results[1:]:
+        assert p["items"] == 30
+    for p in results:
+        assert p["peak_rss"] > 0
+
+
+@pytest.mark.parametrize("cpus", [1, 4])
+@pytest.mark.parametrize("transport", ["aiohttp", "urllib3"])
+def test_async_api(tmp_path, monkeypatch, transport, cpus):
+    web = pytest.importorskip("aiohttp.web")
+    # more than one core moves hashing off the event loop
+    monkeypatch.setattr(os, "cpu_count", lambda: cpus)
+    from aiohttp.test_utils import TestServer
+
+    registry = types.SimpleNamespace(tarballs={}, requests=[])
+
+    async def tarball(request):
+        registry.requests.append(request.path)
+        content = registry.tarballs.get(request.match_info["path"])
+        if content is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=content)
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/{path:.*}", tarball)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            registry.url = str(server.make_url("")).rstrip("/")
+            write_lockfile(tmp_path, registry, count=12, corrupt=("pkg5",))
+            table = await node_modules.resolve(str(tmp_path / "package-lock.json"))
+            assert len(table) == 12
+
+            outdir = tmp_path / "out"
+            outdir.mkdir()
+            cache = str(tmp_path / "cache")
+            results = await node_modules.fetch(table, str(outdir), cache, jobs=4, transport=transport)
+            assert results.pop("pkg5-1.0.5.tgz") is False
+            assert all(results.values())
+            for fn in results:
+                name = fn.rsplit("-", 1)[0]
+                assert (outdir / fn).read_bytes() == registry.tarballs["%s/-/%s" % (name, fn)]
+
+            # everything else comes from the cache now
+            shutil.rmtree(str(outdir))
+            outdir.mkdir()
+            before = len(registry.requests)
+            results = await node_modules.fetch(table, str(outdir), cache, transport=transport)
+            assert registry.requests[before:] == ["/pkg5/-/pkg5-1.0.5.tgz"]
+            assert sum(results.values()) == 11
+        finally:
+            await server.close()
+
+    node_modules._run_async(scenario())
+
+
+def test_lazy_imports():
+    code = "import sys, node_modules; print(' '.join(sorted(sys.modules)))"
+    r = subprocess.run([sys.executable, "-c", code], cwd=str(SCRIPT.parent),
+                       stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = set(r.stdout.split())
+    # asyncio and urllib3 are lazy modules until first used, their
+    # submodules show whether they were loaded
+    for name in ("asyncio.events", "concurrent.futures", "lxml", "subprocess", "urllib3.poolmanager", "xml"):
+        assert name not in modules
+
+
+SERVICE = """<services>
+  <!-- keep me -->
+  <service name="node_modules" mode="manual">
+    <param name="cpio">node_modules.obscpio</param>
+  </service>
+  <service name="download_url">
+    <param name="url">https://example.com/stale.tgz</param>
+    <param name="prefer-old">enable</param>
+  </service>
+  <service name="download_url">
+    <param name="url">https://example.com/mine.tgz</param>
+  </service>
+  <service name="set_version" mode="disabled"/>
+  <service name="recompress" mode="buildtime">
+    <param name="file">caf\u00e9 &amp; &lt;*.tar&gt;</param>
+    <param name="compression" note="a &quot;b&quot;">xz</param>
+  </service>
+  <service name="obs_scm">
+    <param name="scm">git</param>
+    <param name="url">https://github.com/example/cockpit-podman.git</param>
+    <param name="revision">v1.0</param>
+    <param name="version">v1.0</param>
+  </service>
+</services>
+"""
+
+
+def test_obs_service_without_lxml(tmp_path, monkeypatch):
+    pytest.importorskip("lxml")
+    table = node_modules.DependencyTable()
+    url = "https://registry.npmjs.org/leftpad/-/leftpad-1.0.0.tgz"
+    table.deps["leftpad-1.0.0.tgz"] = node_modules.Dependency(url)
+    output = []
+    for lxml in (True, False):
+        if not lxml:
+            monkeypatch.setitem(sys.modules, "lxml", None)
+            # as on Python before 3.9, where indent is missing and
+            # attributes get sorted when writing
+            import xml.etree.ElementTree as ET
+            monkeypatch.delattr(ET, "indent", raising=False)
+            monkeypatch.delattr(ET.ElementTree, "write")
+        fn = tmp_path / "_service"
+        fn.write_text(SERVICE, encoding="utf-8")
+        args = types.SimpleNamespace(obs_service=str(fn), obs_service_scm_only=False, file=None)
+        node_modules.update_obs_service(args, table)
+        output.append(fn.read_text(encoding="utf-8"))
+    assert "keep me" in output[0]
+    assert '<service name="node_modules" mode="manual">' in output[0]
+    assert "mine.tgz" in output[0]
+    assert "stale.tgz" not in output[0]
+    assert "leftpad-1.0.0.tgz" in output[0]
+    assert output[0] == output[1]
+
+
+def test_obs_service_diff(tmp_path):
+    table = node_modules.DependencyTable()
+    for name in ("a", "b", "c"):
+        url = "https://registry.npmjs.org/%s/-/%s-1.0.0.tgz" % (name, name)
+        table.deps["%s-1.0.0.tgz" % name] = node_modules.Dependency(url)
+    table.deps["tool-main.tgz"] = node_modules.Dependency(
+        "https://github.com/example/tool.git", scm="git", branch="main", basename="tool")
+    fn = tmp_path / "_service"
+    fn.write_text(SERVICE, encoding="utf-8")
+    args = types.SimpleNamespace(obs_service=str(fn), obs_service_scm_only=False, file=None)
+    assert node_modules.update_obs_service(args, table)
+    first = fn.read_text()
+    assert first.count("<service") == 10
+
+    # nothing to do, the file is left alone
+    os.utime(str(fn), (0, 0))
+    assert not node_modules.update_obs_service(args, table)
+    assert fn.stat().st_mtime == 0
+
+    # a dropped dependency only removes its own service
+    del table.deps["b-1.0.0.tgz"]
+    table.deps["tool-main.tgz"].branch = "next"
+    assert node_modules.update_obs_service(args, table)
+    second = fn.read_text()
+    assert "b-1.0.0.tgz" not in second
+    assert "<param name=\"revision\">next</param>" in second
+    assert "<param name=\"revision\">main</param>" not in second
+    assert second.count("<service") == 9
+    assert second.index("a-1.0.0.tgz") < second.index("c-1.0.0.tgz") < second.index("tool.git")
+
+    # scm only leaves download_url services alone
+    args.obs_service_scm_only = True
+    del table.deps["a-1.0.0.tgz"]
+    table.deps["tool-main.tgz"].branch = "main"
+    assert node_modules.update_obs_service(args, table)
+    third = fn.read_text()
+    assert "a-1.0.0.tgz" in third
+    assert "<param name=\"revision\">main</param>" in third
+    assert third.count("<service") == 9
+
+    # an obs_scm for another url is not ours, even if it looks like it
+    table.deps.clear()
+    assert not node_modules.update_obs_service(args, table)
+    assert "cockpit-podman.git" in fn.read_text()